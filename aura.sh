@@ -10,9 +10,15 @@ monitor_count=$(xrandr --listactivemonitors 2>/dev/null | awk '/^Monitors:/ {pri
 monitor_id= # can be set to only use specific monitor id
 
 gimp_cmd="nice ionice -c3 gimp"
+gimp_worker=t # use one persistent gimp process for all images, empty - new one for each
+gimp_worker_timeout=$(( 10 * 60 )) # restart worker if single image takes longer than that
+gimp_worker_pool=4 # max number of workers to render images for different monitors in parallel
+prerender_workers=$(nproc 2>/dev/null || echo 2) # parallel workers for --prerender cache warm-up
 
 wps_dir=~/.aura
 favelist="$wps_dir"/favelist
+favelist_table="$wps_dir"/favelist.table # per-image weights, rebuilt on favelist changes
+favelist_decay= # half-life of --fave votes in days, empty - all votes are always +1
 blacklist="$wps_dir"/blacklist
 log_err="$wps_dir"/picker.log
 log_hist="$wps_dir"/history.log
@@ -20,11 +26,32 @@ log_curr="$wps_dir"/current
 pid="$wps_dir"/picker.pid
 hook_onchange="$wps_dir"/hook.onchange
 
+# Persistent list of images in bg paths, only rescanning dirs with changed mtime on startup
+# Updated via inotifywait (inotify-tools) in daemon mode, if available. Set empty to disable.
+catalog_dir="$wps_dir"/catalog
+
 # Cache for processed images
 cache_enabled= # will be enabled if non-empty
 cache_dir="$wps_dir"/cache
 cache_cleanup_keep=$(( 100 * 2**20 )) # how many MiB of cached files to keep (100 MiB)
-cache_cleanup_chance=8 # chance (percent) to run a cleanup routine on image change
+cache_evict=lru # which files to remove first - lru (least recently used) or lfu (least often)
+cache_key=path # path (path+mtime), content (size + sampled data) or content-full (hash of data)
+
+# Index of image sizes from file headers (and after cropping) to skip ones that
+#  won't fit current monitor without decoding them, empty to disable
+index_db="$wps_dir"/index.sqlite
+
+# Pre-render this many next images per monitor in background (daemon with gimp_worker only)
+# These are dropped on monitor geometry or LQR_WPSET_* env changes, 0 to disable
+queue_size=2
+queue_dir="$wps_dir"/queue
+queue_recheck=60 # interval to check/refill the queue at
+
+# Timing/outcome records from gimp workers and bg switches, and a summary of these
+# Summary has p50/p95 switch latency, reject rate, time per processing stage and monitor, etc
+stats_log="$wps_dir"/stats.log # empty to disable
+stats="$wps_dir"/stats
+stats_keep=1000 # number of last records to keep/summarize
 
 # Resets sleep timer in daemon (if running) after oneshot script invocation
 delay_daemon_on_oneshot_change=true # empty for false
@@ -52,6 +79,7 @@ with_pid() {
 
 ## Commanline processing
 action=
+favepick=
 force_break=
 no_fork=
 no_init=
@@ -65,6 +93,7 @@ while [[ -n "$1" ]]; do
 		-m*) monitor_id="${1:2}" ;;
 
 		-d|--daemon) action=daemon ;;
+		--prerender) action=prerender ;;
 		--no-fork) no_fork=true ;;
 		--no-init) no_init=true ;;
 
@@ -73,7 +102,8 @@ while [[ -n "$1" ]]; do
 				echo >&2 "ERROR: not a directory - $2"
 				action=break force_break=true result=1
 			else
-				readarray -t bg_paths < <(sed 's~^[0-9]\+ ~'"${2%/}"'/~' "$favelist")
+				favepick=${2%/}
+				bg_paths=( "$favepick" )
 			fi ;;
 
 		-n|--next)
@@ -113,6 +143,7 @@ Usage:
   $(basename "$0") [opts] paths...
   $(basename "$0") [opts] --favepick directory
   $(basename "$0") [opts] ( -d | --daemon ) [ --no-fork ] [ --no-init ] paths...
+  $(basename "$0") [opts] --prerender paths...
 	$(basename "$0") [ { -m | --monitor } n ] [ -f | --fave ] [ -b | --blacklist ]
   $(basename "$0") [ -n | --next ] [ -c | --current ] [ -k | --kill ] [ -h | --help ]
 
@@ -124,6 +155,12 @@ Blacklisted paths never get picked (see --blacklist).
 specified), and picks/sets a new image on start (unless --no-init is specified),
 and every ${interval}s afterwards.
 
+--prerender command processes all images from the specified paths into cache
+(requires cache_enabled option) for every monitor geometry, using
+${prerender_workers} parallel workers, until cache_cleanup_keep size is reached.
+Already-cached and previously rejected images are skipped, so it can be
+interrupted and re-run to continue from where it stopped.
+
 Some commands (or their one-letter equivalents) can be given instead of paths to
 control already-running instance (started with --daemon flag):
   --next       cycle to then next background immediately.
@@ -161,13 +198,21 @@ fi
 mkdir -p "$wps_dir"
 [[ ! -e "$blacklist" ]] && touch "$blacklist"
 
-if [[ -z "$reexec" ]]; then
+# Catalog files for specific bg_paths, not used with --favepick (picks from favelist)
+catalog=
+[[ -n "$favepick" || -z "$catalog_dir" ]] || {
+	mkdir -p "$catalog_dir"
+	catalog="$catalog_dir"/$( { echo "$PWD"; printf '%s\n' "${bg_paths[@]}"; } |
+		md5sum | cut -d' ' -f1 )
+}
+
+if [[ -z "$reexec" && "$action" != prerender ]]; then
 	if [[ "$action" = daemon && -z "$no_fork" ]]; then
-		setsid "$0" -x "$@" &
+		setsid "$0" -x ${favepick:+--favepick} "$@" &
 		disown
 		exit 0
 	fi
-	[[ $(ps -o 'pgid=' $$) -ne $$ ]] && exec setsid "$0" -x "$@"
+	[[ $(ps -o 'pgid=' $$) -ne $$ ]] && exec setsid "$0" -x ${favepick:+--favepick} "$@"
 fi
 
 if [[ "$action" = daemon ]]; then
@@ -190,7 +235,7 @@ sleep_int() {
 	trap_action=
 	wait $! &>/dev/null
 	local err=$(( $? - 128 ))
-	[[ "$err" -gt 0 ]] && kill "-${err}" 0
+	[[ "$err" -gt 0 ]] && kill "-${err}" $$
 	echo $$ >"$pid"
 	# Sleep extension via recursion - hopefully this won't get too deep
 	[[ "$trap_action" != timer_reset ]] || sleep_int "$interval"
@@ -203,13 +248,154 @@ log() {
 	echo "$2" >>"$1"
 }
 
+## Persistent gimp workers, started on first job and restarted if these die or hang
+# Each worker is identified by name, e.g. "main0" or "queue"
+# Fifos are per-process, so that oneshot runs don't connect to daemon's workers
+declare -A worker_pid worker_req worker_res worker_ts
+worker_start() {
+	local name=$1 fifo="$wps_dir"/worker.$$."$1" fd_req fd_res
+	worker_stop "$name"
+	for fifo in "$fifo".{req,res}; do
+		[[ -p "$fifo" ]] || { rm -f "$fifo"; mkfifo "$fifo" || return 1; }
+	done
+	fifo="${fifo%.res}"
+	# Opening fifos read-write never blocks, and these never get EOF while open
+	exec {fd_req}<>"$fifo".req {fd_res}<>"$fifo".res
+	worker_req[$name]=$fd_req worker_res[$name]=$fd_res
+	$gimp_cmd -ib "(gimp-message-set-handler ERROR-CONSOLE)\
+			(python-fu-lqr-wpset-worker RUN-NONINTERACTIVE\
+				\"${fifo}.req\" \"${fifo}.res\")\
+			(gimp-quit TRUE)" </dev/null 1>/dev/null \
+		2> >(while IFS= read -r line; do log "$log_err" "$line"; done) &
+	worker_pid[$name]=$!
+}
+worker_stop() {
+	local name=$1 fd
+	[[ -n "${worker_pid[$name]}" ]] || return 0
+	kill "${worker_pid[$name]}" 2>/dev/null
+	# Closing fds drops any leftover data in fifos
+	fd=${worker_req[$name]}; exec {fd}>&-
+	fd=${worker_res[$name]}; exec {fd}>&-
+	rm -f "$wps_dir"/worker.$$."$name".{req,res}
+	unset "worker_pid[$name]" "worker_req[$name]" "worker_res[$name]"
+}
+
+## Send job to a worker, result of which can be read via worker_recv
+# Usage: worker_send name command path [key=value ...]
+worker_send() {
+	local name=$1; shift
+	[[ -n "${worker_pid[$name]}" ]] && kill -0 "${worker_pid[$name]}" 2>/dev/null\
+		|| worker_start "$name" || return 1
+	( IFS=$'\t'; echo "$*" ) >&${worker_req[$name]}
+	printf -v "worker_ts[$name]" '%(%s)T' -1
+}
+
+## Read job result from a worker, setting "wps_res" array to tab-separated result line
+# Returns 1 if worker died or timed out (it gets restarted on next job),
+#  or 2 right away if there's no result yet and "nowait" is passed as a second arg
+worker_recv() {
+	local name=$1 nowait=$2 ts
+	while :; do
+		if [[ -z "$nowait" ]] || read -t 0 -u "${worker_res[$name]}"; then
+			IFS=$'\t' read -r -t 5 -u "${worker_res[$name]}" -a wps_res && return 0
+		fi
+		printf -v ts '%(%s)T' -1
+		kill -0 "${worker_pid[$name]}" 2>/dev/null\
+			&& (( ts - ${worker_ts[$name]} < gimp_worker_timeout ))\
+			&& { [[ -z "$nowait" ]] && continue || return 2; }
+		log "$log_err" "--- worker ${name} (pid: ${worker_pid[$name]}) died or timed out, restarting"
+		worker_stop "$name"
+		wps_res=( WPS-ERR:gimp_error )
+		return 1
+	done
+}
+
+# Usage: worker_job name command path [key=value ...]
+worker_job() {
+	worker_send "$@" || { wps_res=( WPS-ERR:gimp_error ); return 1; }
+	worker_recv "$1"
+}
+
+# Set var $2 to value of key=value field $1 from "wps_res" array
+wps_res_get() {
+	local kv
+	for kv in "${wps_res[@]:1}"; do
+		[[ "${kv%%=*}" = "$1" ]] || continue
+		printf -v "$2" '%s' "${kv#*=}"
+		return 0
+	done
+	return 1
+}
+
+## Stats collection
+
+# Set var $1 to current time in microseconds
+ts_us() {
+	local t=${EPOCHREALTIME:-$(date +%s.%6N)}
+	printf -v "$1" '%s' "${t/[.,]/}"
+}
+
+# Append tab-separated record to stats_log, args: type monitor [fields...]
+# Types: switch (time=... for all monitors), render, prerender, apply (fields from wps_res)
+stats_record() {
+	[[ -n "$stats_log" ]] || return 0
+	local ts
+	printf -v ts '%(%s)T' -1
+	( IFS=$'\t'; echo "$ts"$'\t'"$*" ) >>"$stats_log"
+}
+
+# Rotate stats_log and write summary of last stats_keep records to "stats" file
+stats_update() {
+	[[ -n "$stats_log" && -e "$stats_log" ]] || return 0
+	[[ "$(wc -l <"$stats_log")" -le $(( stats_keep * 2 )) ]]\
+		|| { tail -n "$stats_keep" "$stats_log" >"$stats_log".new && mv "$stats_log".new "$stats_log"; }
+	tail -n "$stats_keep" "$stats_log" | awk -F'\t' '
+		function pct(a, n, p,   i, j, v) { # insertion-sort and pick percentile
+			for (i = 2; i <= n; i++) { v = a[i]
+				for (j = i - 1; j > 0 && a[j] > v; j--) a[j+1] = a[j]
+				a[j+1] = v }
+			return n ? a[int((n - 1) * p / 100) + 1] : 0 }
+		{ if (!since) since = $1; records++
+			delete f
+			for (i = 4; i <= NF; i++) if ($i ~ /=/) {
+				k = $i; sub(/=.*/, "", k); f[k] = substr($i, length(k) + 2) } }
+		$2 == "switch" { switch[++switches] = f["time"]; next }
+		$2 != "apply" { jobs++
+			if ($4 == "WPS-OK") ok++
+			else if ($4 == "WPS-ERR:next") { rejected++; reject[f["reject"] ? f["reject"] : "other"]++ }
+			else failed++
+			if (f["cache"] == "hit") cache_hit++; else if (f["cache"] == "miss") cache_miss++
+			if (f["diff_scale"] == "True") diff_scale++
+			bytes += f["bytes"] }
+		{ mon_time[$3] += f["time"]
+			for (k in f) if (k ~ /^time_/) { stage_time[substr(k, 6)] += f[k]; stage_n[substr(k, 6)]++ } }
+		END {
+			printf("since_ts: %d\nrecords: %d\n", since, records)
+			printf("switches: %d\n", switches)
+			printf("switch_latency_p50: %.2f\n", pct(switch, switches, 50))
+			printf("switch_latency_p95: %.2f\n", pct(switch, switches, 95))
+			printf("jobs: %d\njobs_ok: %d\njobs_rejected: %d\njobs_failed: %d\n", jobs, ok, rejected, failed)
+			printf("reject_rate: %.3f\n", jobs ? rejected / jobs : 0)
+			for (k in reject) printf("reject_%s: %d\n", k, reject[k])
+			printf("cache_hit_rate: %.3f\n",
+				cache_hit + cache_miss ? cache_hit / (cache_hit + cache_miss) : 0)
+			printf("diff_scale: %d\nbytes_written: %d\n", diff_scale, bytes)
+			for (k in stage_time) printf("stage_%s_time: %.2f (avg: %.3f)\n",
+				k, stage_time[k], stage_time[k] / stage_n[k])
+			for (k in mon_time) if (k != "-") printf("monitor_%s_time: %.2f\n", k, mon_time[k]) }
+	' >"$stats".new && mv "$stats".new "$stats"
+}
+
+
 ## Cache parameters
 [[ -n "$cache_enabled" ]] && {
 	[[ ! -e "$cache_dir" ]] && { mkdir -p "$cache_dir" || exit 1; }
 	export LQR_WPSET_CACHE_DIR="$cache_dir"
 	export LQR_WPSET_CACHE_SIZE="$cache_cleanup_keep"
-	export LQR_WPSET_CACHE_CLEANUP="$cache_cleanup_chance"
+	export LQR_WPSET_CACHE_EVICT="$cache_evict"
+	export LQR_WPSET_CACHE_KEY="$cache_key"
 }
+export LQR_WPSET_INDEX_DB="$index_db"
 
 ## Monitors
 mon_seq=0 mon_seq_all=0 log_curr_pad=t
@@ -225,15 +411,528 @@ mon_seq=0 mon_seq_all=0 log_curr_pad=t
 }
 
 
-## Main loop
+## Candidate images
 bg_list_ts=0
 bg_count=0
 bg_used=0
 
+# Blacklist is loaded into "blacklist_set" array of file basenames, reloaded on changes
+# Matches same files as "^(.*/)?<basename>$" regexp for any path there would
+declare -A blacklist_set
+blacklist_ts=
+blacklist_load() {
+	local ts line
+	ts=$(stat --printf='%Y %s' "$blacklist" 2>/dev/null)
+	[[ "$ts" != "$blacklist_ts" ]] || return 0
+	blacklist_ts=$ts blacklist_set=()
+	while IFS= read -r line; do
+		[[ -z "$line" ]] || blacklist_set["${line##*/}"]=t
+	done <"$blacklist"
+}
+blacklisted() { [[ -n "${blacklist_set["${1##*/}"]}" ]]; }
+
+# Catalog is stored in "$catalog".files (image paths) and "$catalog".dirs (mtime and path),
+#  with "$catalog".log journal of "+path" (new image), "-path" (removed) and "!path"
+#  (dir change, needs catalog_sync) lines, appended by inotifywait and merged in catalog_sync
+# Images are picked in order of "$catalog".rot (shuffled paths), from position in "$catalog".pos,
+#  which are shared between processes and kept across restarts, reshuffled after each full cycle
+catalog_watch_pid= rotation_ts=
+
+# Run find with specified expression on paths from stdin, via xargs for any number of these
+# Usage: dirs_find find-expr..., e.g. "-maxdepth 0 -printf ..." to only stat listed paths
+dirs_find() {
+	xargs -r -d '\n' sh -c 'n=$1; shift
+		while [ "$n" -gt 0 ]; do set -- "$@" "$1"; shift; n=$((n-1)); done
+		exec find "$@"' dirs_find "$#" "$@" 2>/dev/null
+}
+
+# Merge journal, then read only dirs that were added/changed/removed since last sync
+# Known dirs are only stat'ed for mtime changes, and new subdirs in changed ones are scanned
+#  recursively, so full tree is only walked when there's no "$catalog".dirs yet
+# With "journal" arg, only merges journal entries into files/rotation, without checking dirs
+catalog_sync() {
+	local c=$catalog dirs=() journal=$1
+	(
+		flock 9
+		touch "$c".files "$c".dirs "$c".log
+		cp "$c".log "$c".log.tmp && : >"$c".log
+		if [[ -n "$journal" ]]; then cp "$c".dirs "$c".dirs.new
+		elif [[ ! -s "$c".dirs ]]; then
+			find "${bg_paths[@]}" -type d -printf '%T@ %p\n' 2>/dev/null | sort -k2 >"$c".dirs.new
+		else
+			cut -d' ' -f2- "$c".dirs | dirs_find -maxdepth 0 -type d -printf '%T@ %p\n' >"$c".dirs.new
+			awk 'FNR==1 {n++} n==1 {old[$0]; next} !($0 in old) {print substr($0, index($0, " ") + 1)}'\
+					"$c".dirs "$c".dirs.new |
+				dirs_find -mindepth 1 -maxdepth 1 -type d -printf '%p\n' |
+				awk 'FNR==1 {n++} n==1 {known[substr($0, index($0, " ") + 1)]; next} !($0 in known)'\
+					"$c".dirs.new - |
+				dirs_find -type d -printf '%T@ %p\n' >>"$c".dirs.new
+			sort -k2 -o "$c".dirs.new "$c".dirs.new
+		fi
+		readarray -t dirs < <(
+			awk 'FNR==1 {n++} n==1 {old[$0]; next}
+				{new[$0]; if (!($0 in old)) print substr($0, index($0, " ") + 1)}
+				END {for (d in old) if (!(d in new)) print substr(d, index(d, " ") + 1)}'\
+				"$c".dirs "$c".dirs.new | sort -u )
+		{
+			awk 'FILENAME == ARGV[1] {drop[$0]; next}
+				FILENAME == ARGV[2] { p = substr($0, 2)
+					if ($0 ~ /^\+/) {add[p]; delete rm[p]}
+					else if ($0 ~ /^-/) {rm[p]; delete add[p]}
+					next }
+				{ d = $0; sub(/\/[^\/]*$/, "", d)
+					if (!(d in drop) && !($0 in rm)) print }
+				END {for (p in add) print p}'\
+				<(printf '%s\n' "${dirs[@]}") "$c".log.tmp "$c".files
+			[[ "${#dirs[@]}" -eq 0 ]] || printf '%s\n' "${dirs[@]}" |
+				dirs_find -maxdepth 1 -type f \( -name '*.jpg' -o -name '*.png' \)
+			find "${bg_paths[@]}" -maxdepth 0 -type f 2>/dev/null
+		} | sort -u >"$c".files.new
+		mv "$c".files.new "$c".files
+		mv "$c".dirs.new "$c".dirs
+		rm -f "$c".log.tmp
+
+		# Keep rotation order of known files, dropping removed ones,
+		#  and inserting new ones at random positions after the current one
+		touch "$c".rot
+		{ read -r pos <"$c".pos; } 2>/dev/null || pos=0
+		awk -v pos="${pos:-0}" -v seed="$RANDOM" -v out="$c".pos.new '
+			FILENAME == ARGV[1] {files[$0]; next}
+			{ n++; if (!($0 in files)) { if (n <= pos) drop++; next }
+				seen[$0]; printf("%d\t%s\n", n, $0) }
+			END {
+				srand(seed); if (pos > n) pos = n
+				for (p in files) if (!(p in seen)) add[++n_add] = p
+				span = n - pos > n_add ? n - pos : n_add
+				for (i = 1; i <= n_add; i++) printf("%.6f\t%s\n", pos + 0.5 + rand() * span, add[i])
+				print pos - drop >out }'\
+			"$c".files "$c".rot | sort -t$'\t' -k1,1g | cut -f2- >"$c".rot.new
+		mv "$c".rot.new "$c".rot
+		mv "$c".pos.new "$c".pos
+	) 9>"$c".lock
+}
+
+# Merge new journal entries into files/rotation directly,
+#  returns 1 if catalog_sync is needed to check dirs for changes ("!path" entries)
+catalog_update() {
+	[[ -s "$catalog".log ]] || return 0
+	! grep -q '^!' "$catalog".log || return 1
+	catalog_sync journal
+}
+
+# Load "$catalog".rot into bg_list, if it was replaced since last load
+rotation_load() {
+	local ts
+	ts=$(stat --printf='%i %Y %s' "$catalog".rot 2>/dev/null)
+	[[ "$ts" != "$rotation_ts" ]] || return 0
+	readarray -t bg_list <"$catalog".rot
+	bg_count=${#bg_list[@]} rotation_ts=$ts
+}
+
+# Set "bg" and "bg_n" to next image in rotation and advance shared position,
+#  starting new cycle with reshuffled catalog when the end is reached
+rotation_next() {
+	local fd pos
+	exec {fd}>"$catalog".lock
+	flock "$fd"
+	rotation_load
+	{ read -r pos <"$catalog".pos; } 2>/dev/null || pos=0
+	[[ "${pos:-0}" -lt "$bg_count" ]] || {
+		shuf "$catalog".files >"$catalog".rot.new && mv "$catalog".rot.new "$catalog".rot
+		rotation_load
+		pos=0
+	}
+	bg=${bg_list[pos]} bg_n=$pos
+	echo $(( pos + 1 )) >"$catalog".pos
+	exec {fd}>&-
+}
+
+catalog_watch() {
+	command -v inotifywait >/dev/null || return 1
+	inotifywait -qmr --format '%e %w%f'\
+			-e close_write,moved_to,moved_from,delete,create "${bg_paths[@]}" 2>/dev/null |
+		awk '{ ev = $1; p = substr($0, length(ev) + 2)
+			if (ev ~ /ISDIR/) print "!" p
+			else if (ev ~ /DELETE|MOVED_FROM/) print "-" p
+			else if (ev !~ /CREATE/ && p ~ /\.(jpg|png)$/) print "+" p
+			fflush() }' >>"$catalog".log &
+	catalog_watch_pid=$!
+}
+
+# Weighted --favepick sampling uses alias table (Vose's method) in "$favelist_table",
+#  with "prob alias name" lines, so that each pick is O(1) regardless of vote count
+fave_table_ts= fave_prob=() fave_alias=()
+declare -A fave_used
+
+fave_update() {
+	local ts line n=0
+	fave_used=()
+	[[ -e "$favelist" ]] || touch "$favelist"
+	printf -v ts '%(%s)T' -1
+	[[ -e "$favelist_table" && ! "$favelist" -nt "$favelist_table"
+			&& ! "$blacklist" -nt "$favelist_table" ]]\
+		&& [[ -z "$favelist_decay" || $(( ts - $(stat --printf=%Y "$favelist_table") )) -lt 86400 ]]\
+		|| {
+			awk -v ts="$ts" -v decay="$favelist_decay" '
+				FILENAME != ARGV[2] {bl[$0]; next}
+				{ name = substr($0, index($0, " ") + 1)
+					if (name in bl) next
+					if (!(name in w)) names[n++] = name
+					w[name] += decay ? 2 ^ (-(ts - $1) / (decay * 86400)) : 1 }
+				END {
+					if (!n) exit
+					for (name in w) sum += w[name]
+					for (i = 0; i < n; i++) {
+						p[i] = w[names[i]] * n / sum
+						if (p[i] < 1) small[ns++] = i; else large[nl++] = i }
+					while (ns && nl) {
+						s = small[--ns]; l = large[--nl]
+						alias[s] = l; p[l] -= 1 - p[s]
+						if (p[l] < 1) small[ns++] = l; else large[nl++] = l }
+					while (nl) p[large[--nl]] = 1
+					while (ns) p[small[--ns]] = 1
+					for (i = 0; i < n; i++)
+						printf("%d %d %s\n", p[i] * 2^30, (i in alias) ? alias[i] : i, names[i]) }'\
+				"$blacklist" "$favelist" >"$favelist_table".new
+			mv "$favelist_table".new "$favelist_table"
+		}
+	ts=$(stat --printf=%Y.%s "$favelist_table")
+	[[ "$ts" != "$fave_table_ts" ]] || return 0
+	fave_table_ts=$ts bg_list=() fave_prob=() fave_alias=()
+	while read -r fave_prob[n] fave_alias[n] line; do
+		bg_list[n++]=$line
+	done <"$favelist_table"
+	bg_count=$n bg_used=0
+}
+
+# Weighted pick from favelist alias table, skipping already-used images until next update
+# Falls back to scanning all unused entries from random offset, if random picks keep hitting used ones
+fave_pick() {
+	local n k tries=10
+	while [[ "$bg_count" -gt 0 && "$(( tries-- ))" -gt 0 ]]; do
+		n=$(( (RANDOM << 15 | RANDOM) % bg_count ))
+		[[ "$(( RANDOM << 15 | RANDOM ))" -lt "${fave_prob[n]}" ]] || n=${fave_alias[n]}
+		fave_pick_check $n && return 0
+	done
+	for (( k=0, tries=RANDOM; k < bg_count; k++ )); do
+		fave_pick_check $(( (tries + k) % bg_count )) && return 0
+	done
+	return 1
+}
+
+fave_pick_check() {
+	local n=$1
+	[[ -z "${fave_used[$n]}" ]] || return 1
+	fave_used[$n]=t
+	bg="$favepick/${bg_list[n]}" bg_n=$n
+	blacklisted "$bg" && return 1
+	queued "$bg" && return 1 # can be picked by queue_fill and main loop alike
+	[[ -e "$bg" ]]
+}
+
+# Update bg_list array from catalog rotation (see rotation_next) when it changes,
+#  or via find on dirs' mtime changes if catalog is disabled or can't be kept up to date
+bg_list_update() {
+	local dir update=
+	[[ -z "$favepick" ]] || { fave_update; return; }
+	[[ -z "$catalog" ]] || {
+		[[ -e "$catalog".rot ]] || update=t
+		[[ -z "$catalog_watch_pid" ]] || kill -0 "$catalog_watch_pid" 2>/dev/null || catalog_watch_pid=
+		[[ -n "$update" ]] || catalog_update || update=t
+	}
+	[[ -n "$catalog" ]] || {
+		[[ "$bg_count" -ne 0 ]] || update=t
+		[[ "$(( bg_count - bg_used ))" -ge "$monitor_count" ]] || update=t
+	}
+	[[ -n "$update" || -n "$catalog_watch_pid" ]]\
+		|| for dir in "${bg_paths[@]}"; do
+			[[ "$(stat --printf=%Y "$dir")" -le "$bg_list_ts" ]]\
+				|| { update=t; break; }
+		done
+	[[ -n "$update" ]] || { [[ -z "$catalog" ]] || rotation_load; return 0; }
+	printf -v bg_list_ts '%(%s)T' -1
+	[[ -z "$catalog" ]] || { catalog_sync; rotation_load; return 0; }
+	readarray -t bg_list < <(
+		find "${bg_paths[@]}" -type f \( -name '*.jpg' -o -name '*.png' \) |
+		awk -F/ 'FILENAME != "-" {bl[$NF]; next} !($NF in bl)' "$blacklist" - | shuf )
+	bg_count="${#bg_list[@]}" bg_used=0
+}
+
+# Pick next unused and non-blacklisted image from bg_list or rotation, setting "bg" and "bg_n"
+bg_pick() {
+	local tries
+	blacklist_load
+	[[ -z "$favepick" ]] || { fave_pick; return; }
+	if [[ -n "$catalog" ]]; then
+		for (( tries=bg_count; tries > 0; tries-- )); do
+			rotation_next
+			[[ -n "$bg" ]] || continue
+			blacklisted "$bg" && continue
+			[[ -e "$bg" ]] || continue # removed since catalog update
+			return 0
+		done
+		return 1
+	fi
+	while [[ "$bg_used" -lt "$bg_count" ]]; do
+		bg_n=$bg_used bg="${bg_list[bg_used++]}"
+		# Blacklist check, for entries added after bg_list update
+		blacklisted "$bg" && continue
+		[[ -e "$bg" ]] || continue # removed since bg_list update
+		return 0
+	done
+	return 1
+}
+
+
+## Pre-rendered image queue, filled by separate background worker
+# Each queued image is "$queue_dir/<monitor>/<id>.png" with source path in "<id>.png.src"
+queue_pid= queue_start= queue_key=
+
+# Drops all queued images if monitor geometry or LQR_WPSET_* options change
+# Workers of this process are restarted on such change too, as they can have old geometry
+queue_check() {
+	local key k
+	key=$( { xrandr --listactivemonitors 2>/dev/null
+		env | grep '^LQR_WPSET_' | grep -v '^LQR_WPSET_MONITOR=' | sort; } | md5sum )
+	[[ "$key" = "$queue_key" ]] || {
+		[[ -z "$queue_key" ]] || for k in "${!worker_pid[@]}"; do worker_stop "$k"; done
+		queue_key=$key
+	}
+	[[ "$(cat "$queue_dir"/key 2>/dev/null)" != "$key" ]] || return 0
+	rm -rf "$queue_dir"
+	mkdir -p "$queue_dir" && echo "$key" >"$queue_dir"/key
+}
+
+# Get oldest queued image for monitor $1, setting "bg" and "q_img"
+queue_pop() {
+	local src
+	q_img=
+	[[ -n "$queue_pid" ]] && queue_check || return 1
+	blacklist_load
+	for src in "$queue_dir"/"$1"/*.png.src; do
+		[[ -e "$src" ]] || return 1
+		q_img="${src%.src}" bg=$(<"$src") bg_n=queue
+		blacklisted "$bg" || return 0
+		rm -f "$q_img"{,.src}
+	done
+	q_img=
+	return 1
+}
+
+# Check if image $1 is already queued for any monitor
+queued() {
+	[[ -n "$queue_start" ]] || return 1
+	cat "$queue_dir"/*/*.png.src 2>/dev/null | grep -qFx -- "$1"
+}
+
+queue_fill() {
+	local n q q_img err
+	gimp_cmd="nice $gimp_cmd" # even lower priority than main workers
+	trap 'worker_stop queue' EXIT
+	while :; do
+		queue_check
+		bg_list_update
+		for n in $mon_seq; do
+			mkdir -p "$queue_dir"/$n
+			while :; do
+				q=( "$queue_dir"/$n/*.png.src )
+				[[ -e "$q" ]] || q=()
+				[[ "${#q[@]}" -lt "$queue_size" ]] && bg_pick || break
+				q_img="$queue_dir"/$n/$(date +%s%N).png
+				worker_job queue prerender "$bg" "monitor=${n}" "prerender_path=${q_img}"
+				err="${wps_res[0]#WPS-OK}"
+				stats_record prerender $n "${wps_res[@]}"
+				# Geometry can change while image is being rendered, dropping the queue
+				[[ -z "$err" && "$(cat "$queue_dir"/key 2>/dev/null)" = "$queue_key" ]]\
+					&& printf '%s\n' "$bg" >"$q_img".src || rm -f "$q_img"
+				[[ "$err" != WPS-ERR:gimp_error ]] || break 2
+			done
+		done
+		sleep "$queue_recheck"
+	done
+}
+
+
+## Setting bg on monitors, with "err" set to last error code, if any
+
+# History/current entry update, args: monitor, bg, bg_n
+bg_set_done() {
+	log "$log_hist" "${ts} (id=${3}, mon=${1}): ${2}"
+	sed -i "$(($1+1))c $(basename "$2")" "$log_curr"
+}
+
+# Runs new gimp process for each image and monitor in sequence
+bg_set_gimp() {
+	local n
+	for n in $mon_seq; do
+		export LQR_WPSET_MONITOR=$n
+		err=next
+		while [[ "$err" = next ]]; do
+			bg_pick || { err=; break; }
+			log "$log_err" "--- ${ts}: [monitor-${n}] ${bg}"
+			err=$($gimp_cmd -ib "(catch\
+						(gimp-message \"WPS-ERR:gimp_error\")\
+						(gimp-message-set-handler ERROR-CONSOLE)\
+						(python-fu-lqr-wpset RUN-NONINTERACTIVE \"${bg}\"))\
+					(gimp-quit TRUE)" 2>&1 1>/dev/null |
+				tee -a "$log_err" | grep -o 'WPS-ERR:.\+')
+			err="${err#*:}"
+			[[ -n "$err" ]] || bg_set_done $n "$bg" "$bg_n"
+		done
+	done
+}
+
+# Renders images for all monitors in parallel on a pool of workers,
+#  picking new image for each monitor on WPS-ERR:next, then sets all of them at once
+bg_set_workers() {
+	local n k pool recv busy=0 pending=( $mon_seq )\
+		job_mon=() job_bg=() job_n=() job_q=() res_path=() res_bg=() res_n=() res_w=()
+	pool=$gimp_worker_pool
+	[[ "$pool" -le "${#pending[@]}" ]] || pool=${#pending[@]}
+	[[ -z "$queue_pid" ]] || queue_check # restarts workers before any jobs are sent
+
+	while :; do
+		# Send jobs to all idle workers
+		for (( k=0; k < pool; k++ )); do
+			[[ -z "${job_mon[$k]}" ]] || continue
+			while [[ "${#pending[@]}" -gt 0 ]]; do
+				n=${pending[0]} pending=( "${pending[@]:1}" )
+				queue_pop $n || bg_pick || {
+					log "$log_err" "--- ${ts}: [monitor-${n}] no usable images left, skipped"
+					continue; }
+				log "$log_err" "--- ${ts}: [monitor-${n}] ${bg}"
+				worker_send main$k render "$bg" "monitor=${n}" ${q_img:+"prerender_path=${q_img}"}\
+					|| { err=gimp_error; continue; }
+				job_mon[$k]=$n job_bg[$k]=$bg job_n[$k]=$bg_n job_q[$k]=$q_img
+				(( busy += 1 ))
+				break
+			done
+		done
+		[[ "$busy" -gt 0 ]] || break
+
+		# Collect results, re-queueing monitors with rejected images
+		recv=
+		for (( k=0; k < pool; k++ )); do
+			n=${job_mon[$k]}
+			[[ -n "$n" ]] || continue
+			worker_recv main$k nowait
+			[[ $? -ne 2 ]] || continue
+			job_mon[$k]= recv=t
+			(( busy -= 1 ))
+			stats_record render $n "${wps_res[@]}"
+			[[ -z "${job_q[$k]}" ]] || rm -f "${job_q[$k]}"{,.src}
+			case "${wps_res[0]}" in
+				WPS-OK) wps_res_get path "res_path[$n]"
+					res_bg[$n]=${job_bg[$k]} res_n[$n]=${job_n[$k]} res_w[$n]=main$k ;;
+				WPS-ERR:next) pending+=( $n ) ;;
+				*) err="${wps_res[0]#*:}" ;;
+			esac
+		done
+		[[ -n "$recv" ]] || sleep 0.1
+	done
+
+	# Set all rendered images as bgs at the same time,
+	#  using same workers that rendered them, as these can keep images in memory
+	for n in "${!res_path[@]}"; do
+		worker_send "${res_w[$n]}" apply "${res_path[$n]}" "monitor=${n}"\
+			|| { err=gimp_error; unset "res_w[$n]"; }
+	done
+	for n in "${!res_w[@]}"; do
+		worker_recv "${res_w[$n]}"
+		stats_record apply $n "${wps_res[@]}"
+		[[ "${wps_res[0]}" = WPS-OK ]] || { err="${wps_res[0]#*:}"; continue; }
+		bg_set_done $n "${res_bg[$n]}" "${res_n[$n]}"
+	done
+}
+
+
+## Bulk cache warm-up (--prerender), with progress report on stderr
+prerender() {
+	local k n=0 busy=0 recv full= done=0 hit=0 miss=0 rej=0 fail=0 res eta ts ts0 eol=$'\n' job=()
+	[[ -n "$cache_enabled" ]] || { echo >&2 "ERROR: --prerender requires cache_enabled option"; return 1; }
+	gimp_cmd="nice $gimp_cmd" # even lower priority than main workers
+	trap 'for k in "${!worker_pid[@]}"; do worker_stop "$k"; done' EXIT
+	blacklist_load
+	bg_list_update
+	printf -v ts0 '%(%s)T' -1
+	[[ ! -t 2 ]] || eol=$'\r'
+
+	while :; do
+		for (( k=0; k < prerender_workers; k++ )); do
+			[[ -z "${job[$k]}" ]] || continue
+			while [[ -z "$full" && "$n" -lt "$bg_count" ]]; do
+				bg=${favepick:+$favepick/}${bg_list[n++]}
+				blacklisted "$bg" && { (( done++, rej++ )); continue; }
+				# cache_evict=none stops it with cache_full instead of evicting images rendered before
+				worker_send prerender$k cache "$bg" cache_evict=none || { (( done++, fail++ )); continue; }
+				job[$k]=$bg
+				(( busy += 1 ))
+				break
+			done
+		done
+		[[ "$busy" -gt 0 ]] || break
+
+		recv=
+		for (( k=0; k < prerender_workers; k++ )); do
+			[[ -n "${job[$k]}" ]] || continue
+			worker_recv prerender$k nowait
+			[[ $? -ne 2 ]] || continue
+			(( done++, busy -= 1 ))
+			recv=t
+			case "${wps_res[0]}" in
+				WPS-OK) wps_res_get cache res; [[ "$res" = hit ]] && (( hit++ )) || (( miss++ )) ;;
+				WPS-ERR:next) (( rej++ )) ;;
+				WPS-ERR:cache_full) (( done-- )); n=$bg_count full=t job[$k]=; continue ;;
+				*) (( fail++ ))
+					log "$log_err" "--- prerender failed (${wps_res[0]}): ${job[$k]}" ;;
+			esac
+			job[$k]=
+			printf -v ts '%(%s)T' -1
+			eta=$(( done ? (ts - ts0) * (bg_count - done) / done : 0 ))
+			printf >&2 'prerender: %d/%d (rendered: %d, cached: %d, rejected: %d, failed: %d), eta: %ds%s'\
+				"$done" "$bg_count" "$miss" "$hit" "$rej" "$fail" "$eta" "$eol"
+		done
+		[[ -n "$recv" ]] || sleep 0.1
+	done
+
+	[[ ! -t 2 ]] || echo >&2
+	[[ -z "$full" ]] || echo >&2 "Stopped after cache size reached cache_cleanup_keep limit"
+	[[ "$fail" -eq 0 ]]
+}
+[[ "$action" != prerender ]] || { prerender; exit $?; }
+
+
+## Main loop
 set +m
 trap trap_action=next HUP # "snap outta sleep" signal
 trap trap_action=timer_reset USR1 # "reset sleep" signal
-trap "trap 'exit 0' TERM; pkill -g 0" EXIT # cleanup of backgrounded processes
+# Cleanup of backgrounded processes, worker fifos and temp rotation, if any
+rotation_tmp=
+cleanup() {
+	local k
+	for k in "${!worker_pid[@]}"; do worker_stop "$k"; done
+	[[ -z "$rotation_tmp" ]] || rm -f "$catalog".*
+	trap 'exit 0' TERM
+	pkill -g 0
+}
+trap cleanup EXIT
+
+[[ "$action" = daemon && -n "$gimp_worker" && "$queue_size" -gt 0 ]] && {
+	# Queue and main loop must pick from same rotation to avoid duplicates,
+	#  so non-persistent one is used for this process if catalog is disabled
+	[[ -n "$catalog" || -n "$favepick" ]] || {
+		catalog="$wps_dir"/rotation.$$ rotation_tmp=t
+	}
+	queue_start=t
+}
+[[ "$action" = daemon && -n "$catalog" ]] && {
+	catalog_sync
+	[[ -z "$catalog_dir" ]] || catalog_watch
+}
+[[ -z "$queue_start" ]] || {
+	queue_fill &
+	queue_pid=$!
+}
 
 while :; do
 	# Just sleep if there's no activity
@@ -244,23 +943,7 @@ while :; do
 		continue
 	fi
 
-	# Update bg_list array on dirs' mtime changes or when it gets empty
-	bg_list_update=
-	[[ "$bg_count" -ne 0 ]] || bg_list_update=t
-	[[ "$bg_used" -eq 0 ]] || {
-		[[ "$(($bg_count-$bg_used))" -ge "$monitor_count" ]]\
-			|| { bg_list_update=t; bg_used=0; }
-		[[ -n "$bg_list_update" ]]\
-			|| for dir in "${bg_paths[@]}"; do
-				[[ "$(stat --printf=%Y "$dir")" -le "$bg_list_ts" ]]\
-					|| { bg_list_update=t; break; }
-			done
-	}
-	if [[ -n "$bg_list_update" ]]; then
-		readarray -t bg_list < <(
-			find "${bg_paths[@]}" -type f \( -name '*.jpg' -o -name '*.png' \) | shuf )
-		bg_count="${#bg_list[@]}"
-	fi
+	bg_list_update
 	if [[ "$bg_count" -eq 0 ]]; then
 		echo >&2 "ERROR: no bgz found in the specified paths"
 		sleep_int "$recheck" || break
@@ -269,40 +952,17 @@ while :; do
 
 	# bg update
 	ts="$(date --rfc-3339=seconds)"
-	for n in $mon_seq; do
-		export LQR_WPSET_MONITOR=$n
-		[[ -z "$no_init" ]] && err=next || err=
-		while [[ "$err" = next ]]; do
-			[[ "$bg_used" -lt "$bg_count" ]] || { err=; break; }
-			bg_n=$(shuf -n1 -i 0-$(($bg_count-1)))
-			bg="${bg_list[$bg_n]}"
-			[[ -z "$bg" ]] && continue # not particulary good idea
-
-			# Pop selected bg from array
-			unset bg_list[$bg_n]
-			(( bg_used += 1 ))
-
-			# Blacklist check
-			grep -q "^\(.*/\)\?$(basename "$bg")$" "$blacklist" && continue
-
-			# Actual bg setting
-			log "$log_err" "--- ${ts}: [monitor-${n}] ${bg}"
-			err=$($gimp_cmd -ib "(catch\
-						(gimp-message \"WPS-ERR:gimp_error\")\
-						(gimp-message-set-handler ERROR-CONSOLE)\
-						(python-fu-lqr-wpset RUN-NONINTERACTIVE \"${bg}\"))\
-					(gimp-quit TRUE)" 2>&1 1>/dev/null |
-				tee -a "$log_err" | grep -o 'WPS-ERR:.\+')
-			err="${err#*:}"
-
-			# History/current entry update
-			[[ -n "$err" ]] || {
-				log "$log_hist" "${ts} (id=${bg_n}, mon=${n}): ${bg}"
-				sed -i "$(($n+1))c $(basename "${bg}")" "$log_curr"
-			}
-		done
-	done
+	err=
+	ts_us ts_switch
+	if [[ -n "$no_init" ]]; then ts_switch=
+	elif [[ -n "$gimp_worker" ]]; then bg_set_workers
+	else bg_set_gimp; fi
 	no_init= # reset oneshot --no-init flag
+	[[ -z "$ts_switch" || -n "$err" ]] || {
+		ts_us ts_now; ts_switch=$(( ts_now - ts_switch ))
+		stats_record switch - "time=$(( ts_switch / 1000000 )).$(printf %03d $(( ts_switch / 1000 % 1000 )))"
+		stats_update
+	}
 
 	# Check for unexpected errors
 	if [[ -n "$err" ]]; then
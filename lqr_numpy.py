@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function
+
+####################
+
+# Seam carving (liquid rescale) implementation, using only numpy.
+# Used as lqr_backend=numpy in lqr_wpset.py (should be copied to same plug-ins dir),
+#  instead of gimp-lqr-plugin, or can be used without gimp (requires PIL/pillow for that):
+#   python lqr_numpy.py src.jpg dst.png 1920x1080
+# Parameters are same as ones for plug_in_lqr, and energy function is same as its nrg_func=3
+#  (luma gradient norm), which lqr_wpset uses, but unlike liblqr, energy is not updated
+#  after each removed seam - up to seams_step of these are found in one pass (see carve_w),
+#  and there are no preserve/discard masks.
+
+__author__ = 'Mike Kazantsev'
+__copyright__ = 'Copyright 2011-2018, Mike Kazantsev'
+__license__ = 'WTFPL'
+
+import sys
+
+import numpy as np
+
+
+# Max fraction of image width to carve per seam-search pass
+# Larger values make it faster, but seams are less optimal
+seams_step = 0.02
+
+# Max enlargement per pass, same as enl_step in liblqr (150%)
+enl_step = 1.5
+
+
+def luma(img):
+	'Rec.709 luma in 0-1 range, same as liblqr uses for RGB images, skipping alpha.'
+	if img.shape[2] < 3: return img[...,0].astype(np.float32) / 255.0
+	return np.dot(img[...,:3], np.array([0.2126, 0.7152, 0.0722], dtype=np.float32) / 255.0)
+
+def energy(gray):
+	'''Luma gradient norm, same as LQR_EF_LUMA_GRAD_NORM in liblqr -
+		central differences (halved) inside, one-sided ones on the edges.'''
+	gx, gy = np.zeros_like(gray), np.zeros_like(gray)
+	if gray.shape[1] > 1:
+		gx[:,1:-1] = (gray[:,2:] - gray[:,:-2]) * 0.5
+		gx[:,0], gx[:,-1] = gray[:,1] - gray[:,0], gray[:,-1] - gray[:,-2]
+	if gray.shape[0] > 1:
+		gy[1:-1] = (gray[2:] - gray[:-2]) * 0.5
+		gy[0], gy[-1] = gray[1] - gray[0], gray[-1] - gray[-2]
+	return np.sqrt(gx*gx + gy*gy)
+
+def energy_at(gray, ys, xs):
+	'Same as energy(), but only for pixels at (ys, xs) index arrays, which must be within image.'
+	h, w = gray.shape
+	x0, x1 = np.maximum(xs - 1, 0), np.minimum(xs + 1, w - 1)
+	y0, y1 = np.maximum(ys - 1, 0), np.minimum(ys + 1, h - 1)
+	gx = (gray[ys, x1] - gray[ys, x0]) / np.maximum(x1 - x0, 1).astype(np.float32)
+	gy = (gray[y1, xs] - gray[y0, xs]) / np.maximum(y1 - y0, 1).astype(np.float32)
+	return np.sqrt(gx*gx + gy*gy)
+
+def seams_find(e, n, rigidity=0, delta_x=1):
+	'''Find n non-overlapping vertical seams with lowest cost in energy map.
+		Returns (h, n) array of x coordinates, sorted on each row.'''
+	h, w = e.shape
+	d = max(1, int(delta_x))
+	steps = np.arange(-d, d+1)
+	penalty = rigidity * np.abs(steps)
+	cost = e.copy()
+	pad = np.full(w + 2*d, np.inf, dtype=np.float32)
+	for y in range(1, h):
+		# Min of shifted copies of previous row cost, with rigidity penalty for shift
+		pad[d:d+w] = cost[y-1]
+		prev = pad[d:d+w].copy()
+		for k, dx in enumerate(steps):
+			if dx: np.minimum(prev, pad[d+dx:d+dx+w] + penalty[k], out=prev)
+		cost[y] += prev
+	# Backtrack all seams at once, from n lowest-cost end points,
+	#  picking lowest-cost neighbour on each row, which is same choice as DP made there
+	# Seams are kept in x order and not allowed to meet, pushing them apart if they do
+	n = min(n, w)
+	xs = np.sort(np.argpartition(cost[-1], n-1)[:n] if n < w else np.arange(w))
+	seams = np.empty((h, n), dtype=np.intp)
+	for y in range(h-1, -1, -1):
+		seams[y] = xs = seams_spread(xs, w)
+		if not y: break
+		cand = xs[:,None] + steps
+		cand_cost = np.where( (cand >= 0) & (cand < w),
+			cost[y-1, np.clip(cand, 0, w-1)] + penalty, np.inf )
+		xs = cand[np.arange(n), cand_cost.argmin(axis=1)]
+	return seams
+
+def seams_spread(xs, w):
+	'Make sorted x coordinates of seams on a row (or rows) unique, moving ones that meet apart.'
+	i = np.arange(xs.shape[-1])
+	return np.minimum(np.maximum.accumulate(xs - i, axis=-1), w - len(i)) + i
+
+def downscale(gray, s):
+	'Box-filter 2d array by s, summing strided views, which is faster than mean() on reshape.'
+	h, w = gray.shape[0] // s * s, gray.shape[1] // s * s
+	rows = gray[:h:s, :w].copy()
+	for i in range(1, s): rows += gray[i:h:s, :w]
+	res = rows[:,::s].copy()
+	for i in range(1, s): res += rows[:,i::s]
+	res /= s * s
+	return res
+
+def seams_find_bands(e, base, n, rigidity=0, delta_x=1, chunk=256):
+	'''Same as seams_find, but for (h, m, b) array of energy in m bands of b px,
+			with x of pixel j in band k on row y being base[y, k] + j.
+		Bands are processed as one flat row of m*b px, with indexes of pixels on previous row
+			and back-pointers computed for chunks of rows, to keep numpy calls per row to a minimum.
+		Returns ((h, m, n) array of seams x within bands, (m, n) array of their costs).'''
+	h, m, b = e.shape
+	d = max(1, int(delta_x))
+	steps = np.arange(-d, d+1)[:,None]
+	penalty = (rigidity * np.abs(steps)).astype(np.float32)
+	# Pixel j on row y is at j + shift[y] on row y-1, kept in same band
+	shift = np.zeros((h, m * b), dtype=np.intp)
+	shift[1:] = np.repeat(base[1:] - base[:-1], b, axis=1)
+	j, k0 = np.tile(np.arange(b), m), np.repeat(np.arange(m) * b, b)
+
+	cost = e.reshape(h, m * b).copy()
+	ptr = np.zeros((h, m * b), dtype=np.intp) # index of pixel on previous row for each one
+	for y0 in range(1, h, chunk):
+		ys = np.arange(y0, min(h, y0 + chunk))
+		jj = j + shift[ys][:,None] + steps # (rows, steps, m*b)
+		idx = np.clip(jj, 0, b-1) + k0
+		pen = np.where((jj >= 0) & (jj < b), penalty, np.inf).astype(np.float32)
+		for y, idx_y, pen_y in zip(ys, idx, pen):
+			cost[y] += (cost[y-1].take(idx_y) + pen_y).min(axis=0)
+		# Same choice as min() above, but for all rows at once
+		prev = np.take_along_axis(cost[ys-1][:,None], idx, axis=2) + pen
+		ptr[ys] = np.take_along_axis(idx, prev.argmin(axis=1)[:,None], axis=1)[:,0]
+
+	n = min(n, b)
+	cost_end = cost[-1].reshape(m, b)
+	js = np.sort(np.argpartition(cost_end, n-1, axis=1)[:,:n], axis=1)
+	seams_cost = np.take_along_axis(cost_end, js, axis=1)
+	seams, k0_seams = np.empty((h, m, n), dtype=np.intp), np.arange(m)[:,None] * b
+	for y in range(h-1, -1, -1):
+		seams[y] = js = seams_spread(js, b)
+		if y: js = ptr[y].take(js + k0_seams) - k0_seams
+	return seams, seams_cost
+
+def seams_find_multires(gray, n, levels, rigidity=0, delta_x=1):
+	"""Same as seams_find, but runs DP on image downscaled by s=2^levels first,
+			then runs it at full resolution only within 2s px band around every coarse seam,
+			finding s connected seams there, which is much less work than DP for whole image.
+		Returns (h, n) array of x coordinates, sorted on each row."""
+	h, w = gray.shape
+	s = 2 ** levels
+	hc, wc = h // s, w // s
+	m = min(wc, -(-n // s))
+	# DP in bands is slower per px than on whole rows, so only worth it if bands are narrow
+	if hc < 2 or m < 1 or 2 * m * s > w // 8: return seams_find(energy(gray), n, rigidity, delta_x)
+	xs = seams_find(energy(downscale(gray, s)), m, rigidity, delta_x) * s + s / 2.0
+	# Band centers follow coarse seams, interpolated between centers of coarse rows,
+	#  so that they move by at most ~delta_x px per row, same as seams within them
+	t = np.clip((np.arange(h) + 0.5) / s - 0.5, 0, hc - 1)
+	i0 = t.astype(np.intp)
+	i1, f = np.minimum(i0 + 1, hc - 1), (t - i0)[:,None]
+	base = np.round(xs[i0] * (1 - f) + xs[i1] * f).astype(np.intp) - s # (h, m)
+	xs = base[:,:,None] + np.arange(2 * s) # (h, m, band)
+	# Same as energy(), but only for pixels within bands
+	ev = energy_at(gray, np.arange(h)[:,None,None], np.clip(xs, 0, w-1))
+	ev[(xs < 0) | (xs >= w)] = np.inf
+	seams, seams_cost = seams_find_bands(ev, base, s, rigidity, delta_x)
+	xs = (base[:,:,None] + seams).reshape(h, -1)
+	if xs.shape[1] > n: # drop extra seams with highest cost
+		xs = xs[:, np.sort(np.argpartition(seams_cost.ravel(), n-1)[:n])]
+	return seams_spread(np.sort(xs, axis=1), w)
+
+def seams_mask(shape, seams):
+	mask = np.zeros(shape, dtype=bool)
+	mask[np.arange(shape[0])[:,None], seams] = True
+	return mask
+
+def carve_w(img, w, rigidity=0, delta_x=1, levels=0, vmap=False):
+	'''Remove or duplicate vertical seams in (h, w, c) array until it has specified width.
+		vmap=True (only for removing seams) returns (img, vmap) tuple, where vmap is (h, w0)
+			array with order in which pixels of the original array were removed, and w0 - w for
+			ones that were kept, which can be used to remove any number of these seams, see carve_vmap.'''
+	gray = luma(img) # carved along with image, to avoid recalculating it
+	if vmap:
+		h, w0 = img.shape[:2]
+		if w > w0: raise ValueError('Seams map can only be built when removing seams')
+		order, n_done = np.full((h, w0), w0 - w, dtype=np.int32), 0
+		src_x, rows = np.tile(np.arange(w0, dtype=np.int32), (h, 1)), np.arange(h)[:,None]
+	while img.shape[1] != w:
+		h, w0 = img.shape[:2]
+		n = abs(w - w0)
+		if w < w0: n = min(n, max(1, int(w0 * seams_step)))
+		else: n = min(n, max(1, int(w0 * (enl_step - 1))))
+		seams = seams_find(energy(gray), n, rigidity, delta_x) if not levels\
+			else seams_find_multires(gray, n, levels, rigidity, delta_x)
+		if vmap:
+			# Seams found in one pass are ordered by their energy, same as in energy()
+			ev = energy_at(gray, rows, seams).sum(axis=0)
+			order[rows, src_x[rows, seams]] = n_done + np.argsort(np.argsort(ev))
+			n_done += n
+		mask = seams_mask((h, w0), seams).ravel()
+		if w < w0: idx, w1 = np.flatnonzero(~mask), w0 - n
+		else: idx, w1 = np.repeat(np.arange(h * w0), mask + 1), w0 + n
+		img = np.take(img.reshape(h * w0, -1), idx, axis=0).reshape(h, w1, -1)
+		gray = np.take(gray.ravel(), idx).reshape(h, w1)
+		if vmap: src_x = np.take(src_x.ravel(), idx).reshape(h, w1)
+	return img if not vmap else (img, order)
+
+def carve_vmap(img, vmap, w):
+	'''Remove seams from (h, w0, c) array, using vmap from carve_w(..., vmap=True) for it,
+		to get any width in [w0 - n, w0] range, where n is number of seams removed there.'''
+	h, w0 = vmap.shape
+	keep = (vmap >= w0 - w).ravel()
+	return np.compress(keep, img.reshape(h * w0, -1), axis=0).reshape(h, w, -1)
+
+def rescale(img, w, h, rigidity=0, delta_x=1, res_order=0, levels=0):
+	'''Liquid-rescale (h, w[, c]) uint8 array to specified size.
+		res_order=0 - horizontal first, 1 - vertical first.
+		levels > 0 enables coarse-to-fine seam search, see seams_find_multires.'''
+	ndim, img = img.ndim, img.reshape(img.shape[:2] + (-1,))
+	for axis in ([1, 0] if not res_order else [0, 1]):
+		if axis: img = carve_w(img, w, rigidity, delta_x, levels)
+		else: img = carve_w(img.transpose(1, 0, 2), h, rigidity, delta_x, levels).transpose(1, 0, 2)
+	if ndim == 2: img = img[...,0]
+	return np.ascontiguousarray(img)
+
+
+def prescale_size(w0, h0, w, h):
+	'Size to scale image to before lqr, preserving aspect, same as two-pass mode in lqr_wpset.'
+	if float(w0) / h0 > float(w) / h: return int(round(w0 * float(h) / h0)), h
+	return w, int(round(h0 * float(w) / w0))
+
+def main(args=None):
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='Liquid-rescale image to specified size.')
+	parser.add_argument('src', help='Source image path.')
+	parser.add_argument('dst', nargs='?', help='Destination image path.')
+	parser.add_argument('size', help='Target size, in WxH format.')
+	parser.add_argument('-r', '--rigidity', type=float, default=0,
+		help='Seams rigidity, see plug_in_lqr docs (default: %(default)s).')
+	parser.add_argument('-d', '--delta-x', type=int, default=1,
+		help='Max seam step, see plug_in_lqr docs (default: %(default)s).')
+	parser.add_argument('-v', '--vertical-first', action='store_true',
+		help='Rescale height first, then width.')
+	parser.add_argument('-l', '--levels', type=int, default=0,
+		help='Find seams on image downscaled by 2^levels, then refine'
+			' them at full resolution - faster, but lower quality (default: %(default)s).')
+	parser.add_argument('-p', '--prescale', action='store_true',
+		help='Scale image with bicubic filter, preserving aspect, before liquid rescale.')
+	parser.add_argument('-b', '--bench', metavar='levels',
+		help='Instead of saving image, print time it takes to process it with'
+			' and without --prescale for each of comma-separated --levels values,'
+			' and to build seams map with --prescale, then re-target image using it.')
+	opts = parser.parse_args(sys.argv[1:] if args is None else args)
+	if not (opts.dst or opts.bench): parser.error('Destination path must be specified')
+
+	from PIL import Image
+	import time
+	w, h = map(int, opts.size.lower().split('x', 1))
+	src = Image.open(opts.src).convert('RGB')
+
+	def process(prescale, levels):
+		img = src if not prescale else\
+			src.resize(prescale_size(src.width, src.height, w, h), Image.BICUBIC)
+		return rescale( np.asarray(img), w, h, opts.rigidity,
+			opts.delta_x, int(opts.vertical_first), levels )
+
+	if not opts.bench:
+		Image.fromarray(process(opts.prescale, opts.levels)).save(opts.dst)
+		return
+
+	print('Image: {} ({}x{} -> {}x{})'.format(opts.src, src.width, src.height, w, h))
+	for prescale in True, False:
+		for levels in map(int, opts.bench.split(',')):
+			ts = time.time()
+			process(prescale, levels)
+			print('  prescale={} levels={}: {:.1f}s'.format(
+				['no', 'yes'][prescale], levels, time.time() - ts ))
+
+	# After prescale, only rows or columns are removed, so seams map covers whole rescale
+	img = np.asarray(src.resize(prescale_size(src.width, src.height, w, h), Image.BICUBIC))
+	axis = int(img.shape[1] == w)
+	if axis: img = img.transpose(1, 0, 2)
+	for levels in map(int, opts.bench.split(',')):
+		ts = time.time()
+		vmap = carve_w(img, [w, h][axis], opts.rigidity, opts.delta_x, levels, vmap=True)[1]
+		ts, ts_map = time.time(), time.time() - ts
+		carve_vmap(img, vmap, [w, h][axis])
+		print('  seams map levels={}: {:.1f}s, re-target using it: {:.2f}s'.format(
+			levels, ts_map, time.time() - ts ))
+
+if __name__ == '__main__': sys.exit(main())
@@ -13,6 +13,11 @@ from __future__ import unicode_literals, print_function
 #       (gimp-message-set-handler ERROR-CONSOLE)
 #       (python-fu-lqr-wpset RUN-NONINTERACTIVE "file.jpg"))
 #     (gimp-quit TRUE)' 2>&1 1>/dev/null | tee log | grep WS-ERR
+# Persistent worker, processing jobs (one per line) from fifo/file, see lqr_wpset_worker:
+#   mkfifo req res; gimp -ib '(python-fu-lqr-wpset-worker RUN-NONINTERACTIVE "req" "res")' &
+#   printf 'set\tfile.jpg\tmonitor=1\n' >req; head -1 res
+# Benchmark of processing stages on generated images, see lqr_wpset_bench:
+#   gimp -ib '(python-fu-lqr-wpset-bench RUN-NONINTERACTIVE "bench-imgs" "bench.json") (gimp-quit TRUE)'
 
 __author__ = 'Mike Kazantsev'
 __copyright__ = 'Copyright 2011-2018, Mike Kazantsev'
@@ -28,13 +33,42 @@ __description__ = 'LQR-rescale image to desktop size and set as a background.'
 conf = dict(
 	# Methods to try setting bg with, separated by spaces
 	# Ones that support multiple monitors: enlightenment x-root-window
+	# With only x-root-window, no image file is written, and pixel data is used directly
 	bg_set_methods = 'gsettings gconf xfconf enlightenment x-root-window',
+	bg_set_timeout = 5.0, # seconds to wait for all bg_set_methods to finish
 
 	# Physical monitor number, 0-indexed
 	# Some bg_set_methods above still not patched/tested to support picking monitor
 	monitor = 0,
+	monitor_size = '', # WxH to render image for instead of monitor size, e.g. for benchmarks
 
 	min_prescale_diff = 0.3, # use cubic on larger images (preserving aspect), then lqr
+	# Decode JPEGs at reduced size (libjpeg scaling - 1/2, 1/4, 1/8) if these are
+	#  more than 2x this much larger than needed to cover the screen, 0 - disabled
+	# Uses PIL (draft mode) or djpeg (libjpeg-turbo-progs), whichever is available
+	# Extra resolution (this factor) is kept for cropping margins and prescale quality
+	shrink_on_load = 1.5,
+
+	# Solid-color margins are cropped from images, allowing for this much noise there
+	# Max difference from margin color (0-255) for any color channel of any pixel
+	# Pixels right inside the margin should differ from it by more than that on average
+	crop_tolerance = 12,
+
+	# Liquid rescale implementation - "gimp" (gimp-lqr-plugin)
+	#  or "numpy" (lqr_numpy.py module from same dir as this plugin, requires numpy)
+	lqr_backend = 'gimp',
+	# Parameters for lqr, see gimp-lqr-plugin docs (res_order: 0 - horizontal first)
+	lqr_rigidity = 0.0, lqr_delta_x = 1, lqr_res_order = 0,
+	# Find seams on image downscaled by 2^N first, with numpy backend only
+	# Faster on large images, but lower quality, 0 - disabled, see also lqr_numpy.py --bench
+	lqr_levels = 0,
+	# Store map of seams for each image in cache_dir (see lqr_numpy.carve_w), with numpy backend only,
+	#  to re-target it to other geometries (e.g. after resolution change) without finding seams again
+	# Image is always prescaled with this option, so that lqr only has to remove rows or columns,
+	#  and map has lqr_seams_extra (fraction of these) more seams, for nearby aspect ratios
+	# Re-targeted image is scaled to new size from the one map was built for,
+	#  which is only done if that doesn't upscale it by more than lqr_seams_max_scale
+	lqr_seams = False, lqr_seams_extra = 0.1, lqr_seams_max_scale = 1.25,
 
 	# Don't process images N times smaller by width/height or area (w*h)
 	# (1920*1080) / (800*600) = 4.32
@@ -66,12 +100,40 @@ conf = dict(
 	# All files matching the pattern for current monitor will be a subject to cleanup!
 	# Do not use asterisks in this pattern
 	result_path = '/tmp/.lqr_wpset_bg.{monitor}.{id}.png',
+	# Format of the result file, replacing extension in result_path - png, bmp or ppm
+	# bmp/ppm are fastest to write/read, and should work with any bg_set_methods above,
+	#  but can be quite large, which might matter if result_path is not on tmpfs
+	result_format = 'png',
+	# zlib compression level for png files (0-9), -1 - use gimp defaults
+	# Result files are removed on next bg change, so faster compression is usually better
+	result_compression = 1,
 
 	# Cache for scaled images is disabled by default
+	# Files there are tracked in "cache.sqlite" db, with least-recently-used ("lru")
+	#  or least-frequently-used ("lfu") ones removed on each insert to keep total under cache_size
 	cache_dir = '',
 	cache_size = 0.0,
-	cache_cleanup = 0.0,
+	cache_evict = 'lru', # "none" - raise "cache_full" error instead, used for --prerender in aura.sh
+	cache_compression = -1, # same as result_compression, but for cached files
+	# What identifies source image for cached files:
+	#  "path" - its realpath and mtime, "content" - fast fingerprint of size and sampled data blocks,
+	#  "content-full" - hash of all file contents (read once, stored in index_db, if enabled)
+	# Content keys allow moved/renamed/duplicate files to reuse same cached images,
+	#  but "content" can miss in-place edits that don't change file size or sampled blocks
+	cache_key = 'path',
+	# Also process newly-loaded images into cache for geometries of all other monitors,
+	#  from same decoded/cropped image, so that these are cached when picked for other ones
+	cache_all_monitors = False,
 	recache = False, # oneshot flag to ignore cached image
+
+	# Already processed image (without label) to use instead of processing source one,
+	#  or where to save such image with "prerender" worker command, see lqr_wpset_worker
+	prerender_path = '',
+
+	# sqlite db to store image sizes (read from file headers, then post-crop) and tags in
+	# Allows to skip decoding images that won't pass size checks anyway,
+	#  as well as decoding/parsing original image for label on cache hits, disabled if empty
+	index_db = '',
 )
 
 # see also extra-bulky "label_tags" definition in the script's tail
@@ -82,8 +144,9 @@ conf = dict(
 
 import itertools as it, operator as op, functools as ft
 from datetime import datetime
-from tempfile import mkstemp
-import os, sys, types, glob, collections, random, hashlib
+from tempfile import mkstemp, mkdtemp
+from contextlib import contextmanager
+import os, sys, types, glob, collections, random, hashlib, shutil, time, json
 
 import re
 re_type = type(re.compile(''))
@@ -105,9 +168,10 @@ def gimp_color(c):
 		assert all((cc <= 0xff) for cc in c), c
 	return c
 
-def update_conf_from_env(conf, prefix='LQR_WPSET_', enc='utf-8'):
+def update_conf_from_env(conf, prefix='LQR_WPSET_', enc='utf-8', env=None):
+	if env is None: env = os.environ
 	for k,v in conf.viewitems():
-		v_env = os.environ.get('{}{}'.format(prefix, k.upper()))
+		v_env = env.get('{}{}'.format(prefix, k.upper()))
 		if v_env is None: continue
 		t = type(v)
 		if t in [int, float, bytes]: conf[k] = t(v_env)
@@ -121,8 +185,243 @@ def update_conf_from_env(conf, prefix='LQR_WPSET_', enc='utf-8'):
 	conf['label_colors'] = list(gimp_color(c) for c in conf['label_colors'])
 	conf['diff_w_bg_solid_color'] = gimp_color(conf['diff_w_bg_solid_color'])
 	conf['bg_set_methods'] = conf['bg_set_methods'].split()
-update_conf_from_env(conf)
-conf = type(b'Conf', (object,), conf) # for easier attr-access
+
+def conf_init(overrides=None, prefix='LQR_WPSET_'):
+	'Build conf object from defaults, env and overrides dict, which has same keys as conf.'
+	conf, env = conf_base.copy(), os.environ.copy()
+	if overrides:
+		env.update(('{}{}'.format(prefix, k.upper()), v) for k,v in overrides.viewitems())
+	update_conf_from_env(conf, prefix, env=env)
+	return type(b'Conf', (object,), conf) # for easier attr-access
+
+conf_base = conf
+conf = conf_init()
+
+
+class WPSError(Exception):
+	'''Error code to report to aura.sh via "WPS-ERR:<code>" message or worker result line.
+		Optional info dict is added to the worker result line as well, e.g. reject reason.'''
+	def __init__(self, code, info=None):
+		super(WPSError, self).__init__(code)
+		self.info = info or dict()
+
+
+def peak_rss():
+	'Peak RSS of gimp and plugin processes (sum of VmHWM, KiB) since last peak_rss_reset().'
+	rss = 0
+	for pid in os.getpid(), os.getppid():
+		try:
+			with open('/proc/{}/status'.format(pid)) as src:
+				for line in src:
+					if line.startswith('VmHWM:'): rss += int(line.split()[1])
+		except (OSError, IOError): pass
+	return rss
+
+def peak_rss_reset():
+	'Reset peak RSS counters of gimp and plugin processes to current RSS.'
+	for pid in os.getpid(), os.getppid():
+		try:
+			with open('/proc/{}/clear_refs'.format(pid), 'wb') as dst: dst.write(b'5')
+		except (OSError, IOError): pass # not linux or not allowed
+
+_stage_rss = list() # peak RSS of enclosing stages, as counters are reset for nested ones
+
+@contextmanager
+def stage(result, name):
+	'''Add wall time of the block to time_<name> in result dict,
+			and peak RSS during it (max of all blocks with same name) to rss_peak_<name>.
+		If WPSError gets raised (e.g. image rejected), result is also added to its info.'''
+	def stage_done():
+		result['time_{}'.format(name)] = round(
+			result.get('time_{}'.format(name), 0) + time.time() - ts, 3 )
+		rss = max(_stage_rss.pop(), peak_rss())
+		if _stage_rss: _stage_rss[-1] = max(_stage_rss[-1], rss)
+		k = 'rss_peak_{}'.format(name)
+		result[k] = max(result.get(k, 0), rss)
+	if _stage_rss: _stage_rss[-1] = max(_stage_rss[-1], peak_rss())
+	peak_rss_reset()
+	_stage_rss.append(0)
+	ts = time.time()
+	try: yield
+	except WPSError as err:
+		stage_done()
+		err.info.update(result)
+		raise
+	except Exception:
+		_stage_rss.pop()
+		raise
+	stage_done()
+
+
+_sqlite_dbs = dict()
+
+def sqlite_db(path, schema):
+	'Return persistent sqlite3 connection to path, creating db with schema if necessary.'
+	if path not in _sqlite_dbs:
+		import sqlite3
+		db = sqlite3.connect(path, timeout=60)
+		db.text_factory = bytes # paths are not always utf-8
+		db.executescript(schema)
+		_sqlite_dbs[path] = db
+	return _sqlite_dbs[path]
+
+index_db_schema = '''
+	drop table if exists image_size; -- older table, mixing header and cropped sizes
+	create table if not exists image_crop_size (
+		path text primary key, mtime real, size integer, w integer, h integer );
+	create table if not exists image_meta (
+		path text primary key, mtime real, tags_key text, size text, tags text );
+	create table if not exists fingerprint (
+		path text, kind text, mtime real, size integer, fp text, primary key (path, kind) );'''
+
+def index_db():
+	'Return sqlite3 connection to conf.index_db or None if it is disabled.'
+	if conf.index_db: return sqlite_db(conf.index_db, index_db_schema)
+
+
+cache_db_schema = '''
+	create table if not exists cache (
+		name text primary key, size integer, atime real, hits integer );
+	create index if not exists cache_lru on cache (atime);
+	create index if not exists cache_lfu on cache (hits, atime);
+	create table if not exists cache_stats (name text primary key, value integer);'''
+
+def cache_db():
+	'Return sqlite3 connection to cache_dir manifest db, populating it from files there initially.'
+	db = sqlite_db(os.path.join(conf.cache_dir, 'cache.sqlite'), cache_db_schema)
+	if not db.execute('select 1 from cache_stats where name = ?', ('size',)).fetchone():
+		with db:
+			size = 0
+			for p in os.listdir(conf.cache_dir):
+				if not p.endswith(('.png', '.npz')): continue
+				try: st = os.stat(os.path.join(conf.cache_dir, p))
+				except (OSError, IOError):
+					pdb.gimp_message('WPS-WARN: Unable to access cache path: {!r}'.format(p))
+					continue
+				db.execute( 'insert or replace into cache'
+					' values (?, ?, ?, 0)', (p, st.st_size, st.st_mtime) )
+				size += st.st_size
+			cache_stat(db, 'size', size)
+	return db
+
+def cache_stat(db, k, n=1):
+	db.execute('insert or ignore into cache_stats values (?, 0)', (k,))
+	db.execute('update cache_stats set value = value + ? where name = ?', (n, k))
+
+def cache_stats():
+	'Return dict of cache_stats counters: hit, miss, size, evict.'
+	return dict(cache_db().execute('select name, value from cache_stats'))
+
+def cache_hit(path, count=True):
+	'''Update access time/counters for cached file on path, or miss counter if path is None.
+		count=False only updates access time/hits for the file, but not cache_stats counters.'''
+	db = cache_db()
+	with db:
+		if not path: return cache_stat(db, 'miss')
+		name = os.path.basename(path)
+		if count: cache_stat(db, 'hit')
+		if not db.execute( 'update cache set atime = ?,'
+				' hits = hits + 1 where name = ?', (time.time(), name) ).rowcount:
+			size = os.stat(path).st_size # file not in manifest, e.g. copied there
+			db.execute('insert into cache values (?, ?, ?, 1)', (name, size, time.time()))
+			cache_stat(db, 'size', size)
+
+def cache_add(path):
+	'''Add/replace file on path in cache manifest,
+		removing other files until total size is within cache_size, or only this one is left.
+		With cache_evict=none, file is removed and WPSError("cache_full") raised instead.
+		Returns size of the added file.'''
+	db, name, size_file = cache_db(), os.path.basename(path), os.stat(path).st_size
+	evict_order = dict(lru='atime', lfu='hits, atime', none=None)[conf.cache_evict]
+	with db:
+		size_old = db.execute('select size from cache where name = ?', (name,)).fetchone()
+		db.execute('insert or replace into cache values (?, ?, ?, 1)', (name, size_file, time.time()))
+		cache_stat(db, 'size', size_file - (size_old[0] if size_old else 0))
+		size, = db.execute('select value from cache_stats where name = ?', ('size',)).fetchone()
+		if not evict_order and size > conf.cache_size:
+			os.unlink(path)
+			raise WPSError('cache_full') # rolls back transaction
+		while size > conf.cache_size:
+			row = db.execute( 'select name, size from cache where name != ?'
+				' order by {} limit 1'.format(evict_order), (name,) ).fetchone()
+			if not row: break # only just-added file is left
+			name_evict, size_evict = row
+			try: os.unlink(os.path.join(conf.cache_dir, name_evict))
+			except (OSError, IOError): pass # removed by other worker or manually
+			db.execute('delete from cache where name = ?', (name_evict,))
+			cache_stat(db, 'size', -size_evict)
+			cache_stat(db, 'evict')
+			size -= size_evict
+	return size_file
+
+
+def image_header_size(path):
+	'Get (width, height) of JPEG/PNG image from its header without decoding it, or None.'
+	import struct
+	try:
+		with open(path, 'rb') as src:
+			head = src.read(24)
+			if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+				return struct.unpack(b'>II', head[16:24])
+			if not head.startswith(b'\xff\xd8'): return
+			src.seek(2)
+			while True:
+				marker = src.read(1)
+				while marker and marker != b'\xff': marker = src.read(1)
+				while marker == b'\xff': marker = src.read(1) # fill bytes
+				if not marker: return
+				marker = ord(marker)
+				if marker == 0x01 or 0xd0 <= marker <= 0xd8: continue # no length
+				if marker in [0xd9, 0xda]: return # no SOFn before image data
+				seg_len, = struct.unpack(b'>H', src.read(2))
+				if 0xc0 <= marker <= 0xcf and marker not in [0xc4, 0xc8, 0xcc]: # SOFn
+					h, w = struct.unpack(b'>xHH', src.read(5))
+					return w, h
+				src.seek(seg_len - 2, os.SEEK_CUR)
+	except (OSError, IOError, struct.error): return
+
+def index_image_size(path, size=None):
+	'''Get ((width, height), cropped) of an image from index_db or file header, if possible.
+		cropped=False is for size from the header, which is only an upper bound for cropped size.
+		If size is passed, it is stored in the index instead, and should be the one
+			after image_crop(), so that subsequent checks can use it without any decoding.'''
+	db, st = index_db(), os.stat(path)
+	key = os.path.realpath(path), st.st_mtime, st.st_size
+	if size:
+		if db:
+			with db: db.execute( 'insert or replace into'
+				' image_crop_size values (?, ?, ?, ?, ?)', key + tuple(size) )
+		return size, True
+	if db:
+		size = db.execute( 'select w, h from image_crop_size'
+			' where path = ? and mtime = ? and size = ?', key ).fetchone()
+		if size: return tuple(size), True
+	return image_header_size(path), False
+
+fingerprint_blocks = 16 # number of evenly-spaced blocks to hash for "content" cache_key
+fingerprint_block_size = 2**12
+
+def image_fingerprint(path, full=False):
+	'''Get hash of file size and fingerprint_blocks sampled from it,
+			or whole contents if full=True, stored in index_db for path/mtime/size.'''
+	db, st, kind = index_db(), os.stat(path), ['sampled', 'full'][bool(full)]
+	key = os.path.realpath(path), kind, st.st_mtime, st.st_size
+	if db:
+		fp = db.execute( 'select fp from fingerprint where path = ?'
+			' and kind = ? and mtime = ? and size = ?', key ).fetchone()
+		if fp: return fp[0]
+	fp, bs, n = hashlib.sha256(bytes(st.st_size)), fingerprint_block_size, fingerprint_blocks
+	with open(path, 'rb') as src:
+		if full or st.st_size <= bs * n:
+			for buff in iter(ft.partial(src.read, 2**20), b''): fp.update(buff)
+		else:
+			for i in xrange(n):
+				src.seek(i * (st.st_size - bs) // (n - 1))
+				fp.update(src.read(bs))
+	fp = fp.hexdigest()
+	if db:
+		with db: db.execute('insert or replace into fingerprint values (?, ?, ?, ?, ?)', key + (fp,))
+	return fp
 
 
 def process_tags(path):
@@ -167,67 +466,156 @@ def process_tags(path):
 	return meta
 
 
-def set_background_from_file(path):
+# Last image rendered in-memory for each monitor, as (id, pixbuf), to be set via wpset_apply
+# Used instead of result files when only x-root-window method is enabled
+pixbufs = dict()
+
+class BGSetUnavailable(Exception): pass
+class BGSetTimeout(Exception): pass
+
+_session_bus = None
+
+def session_bus():
+	'Return persistent dbus session bus connection, shared by all setters.'
+	global _session_bus
+	if not _session_bus:
+		try: import dbus
+		except ImportError: raise BGSetUnavailable('no dbus module')
+		_session_bus = dbus.SessionBus()
+	return _session_bus
+
+def dbus_call(func, *args, **kws):
+	'Call dbus method with bg_set_timeout, raising BGSetUnavailable if service is not running.'
+	import dbus
+	try: return func(*args, timeout=conf.bg_set_timeout, **kws)
+	except dbus.exceptions.DBusException as err:
+		if err.get_dbus_name() == 'org.freedesktop.DBus.Error.ServiceUnknown':
+			raise BGSetUnavailable(err.get_dbus_name())
+		raise
+
+def bg_set_gsettings(path):
+	## GSettings - newer GNOME, Unity
+	# Using gi.repository.Gio here directly is tricky alongside gimp's gtk2
+	from subprocess import Popen, PIPE
+	from urllib import quote
+	try:
+		proc = Popen([ 'gsettings', 'set',
+			'org.gnome.desktop.background', 'picture-uri',
+			'file://{0}'.format(quote(path)) ],
+			stderr=PIPE, env=dict(os.environ, LC_ALL='C') ) # untranslated errors
+	except OSError: raise BGSetUnavailable('no gsettings binary')
+	deadline = time.time() + conf.bg_set_timeout
+	while proc.poll() is None:
+		if time.time() > deadline:
+			proc.kill()
+			raise BGSetTimeout()
+		time.sleep(0.01)
+	if proc.returncode:
+		err = proc.stderr.read().decode('utf-8', 'replace').strip()
+		if 'No such schema' in err: raise BGSetUnavailable('no schema')
+		raise RuntimeError('gsettings failed (code={}): {}'.format(proc.returncode, err))
+
+def bg_set_gconf(path):
+	## Gconf - older GNOME, XFCE/nautilus and such
+	try: import gconf
+	except ImportError: raise BGSetUnavailable('no gconf module')
+	gconf.client_get_default().set_string(
+		'/desktop/gnome/background/picture_filename', path )
+
+def bg_set_xfconf(path):
+	## Xfconf (via dbus interface) - XFCE/xfdesktop
+	bus = session_bus()
+	import dbus
+	xfconf = dbus.Interface(
+		bus.get_object('org.xfce.Xfconf', '/org/xfce/Xfconf'),
+		dbus_interface='org.xfce.Xfconf' )
+	for k,v in dbus_call(xfconf.GetAllProperties, 'xfce4-desktop', '/backdrop').iteritems():
+		if k.endswith('/image-path'): dbus_call(xfconf.SetProperty, 'xfce4-desktop', k, path)
+
+def bg_set_enlightenment(path):
+	## E17+ edbus interface
+	bus = session_bus()
+	import dbus
+	edbus = bus.get_object(
+		'org.enlightenment.wm.service', '/org/enlightenment/wm/RemoteObject' )
+	dxc, dyc = dbus_call(edbus.GetVirtualCount, dbus_interface='org.enlightenment.wm.Desktop')
+	edbus = dbus.Interface( edbus,
+		dbus_interface='org.enlightenment.wm.Desktop.Background' )
+	for dx, dy in it.product(xrange(dxc), xrange(dyc)):
+		dbus_call(edbus.Add, conf.monitor, dx, dy, path)
+
+def bg_set_x_root_window(path):
+	set_background_root_window(gtk.gdk.pixbuf_new_from_file(path))
+
+bg_setters = {
+	'gsettings': bg_set_gsettings, 'gconf': bg_set_gconf,
+	'xfconf': bg_set_xfconf, 'enlightenment': bg_set_enlightenment,
+	'x-root-window': bg_set_x_root_window }
+
+# Methods that need image file, not just pixel data, see wpset
+bg_set_methods_file = 'gsettings', 'gconf', 'xfconf', 'enlightenment'
+
+# Methods that raised BGSetUnavailable, skipped for the rest of the process lifetime
+bg_set_unavailable = set()
+
+def set_background_from_file(path, result=None):
+	'''Set bg via all enabled bg_set_methods, each in a separate thread,
+			waiting for bg_set_timeout, except x-root-window, which is painted from main one.
+		Status and wall time for each method are stored in result
+			as set_<method> (ok, unavailable, timeout, error) and time_set_<method>.'''
 	# Note that the path is not unlinked, because gconf and xfconf set bg
 	#  asynchronously, so there's no way of knowing when the image will
 	#  actually be used
+	import threading, traceback
+	if result is None: result = dict()
+	status, ts = dict(), time.time()
+
+	def run(method):
+		res = 'ok'
+		try: bg_setters[method](path)
+		except BGSetUnavailable:
+			bg_set_unavailable.add(method)
+			res = 'unavailable'
+		except BGSetTimeout: res = 'timeout'
+		except Exception: res = 'error', traceback.format_exc()
+		status[method] = res, time.time() - ts
+
+	methods = list( m for m in conf.bg_set_methods
+		if m in bg_setters and m not in bg_set_unavailable )
+	threads = list()
+	for method in methods:
+		if method == 'x-root-window': continue # gtk calls are not thread-safe
+		threads.append(threading.Thread(target=run, args=[method]))
+		threads[-1].daemon = True # don't wait for these on exit
+		threads[-1].start()
+	if 'x-root-window' in methods: run('x-root-window')
+	for t in threads: t.join(max(0, ts + conf.bg_set_timeout - time.time()))
+
+	for method in methods:
+		res, td = status.get(method, ('timeout', time.time() - ts))
+		if isinstance(res, tuple):
+			res, err = res
+			pdb.gimp_message('WPS-WARN: bg setter failed ({}): {}'.format(method, err))
+		method = method.replace('-', '_')
+		result['set_{}'.format(method)], result['time_set_{}'.format(method)] = res, round(td, 3)
+	return result
+
+def set_background_root_window(pb):
+	## Paint X root window via pygtk
+	pos = gtk.gdk.DisplayManager().get_default_display()\
+		.get_default_screen().get_monitor_geometry(conf.monitor)
+	win = gtk.gdk.get_default_root_window()
+	win.draw_pixbuf(gtk.gdk.GC(win), pb, 0, 0, pos.x, pos.y, -1, -1)
+	gtk.gdk.flush() # worker doesn't exit, which would've flushed it otherwise
 
-	if 'gsettings' in conf.bg_set_methods:
-		## GSettings - newer GNOME, Unity
-		# Using gi.repository.Gio here directly is tricky alongside gimp's gtk2
-		from subprocess import call
-		from urllib import quote
-		call([ 'gsettings', 'set',
-			'org.gnome.desktop.background', 'picture-uri',
-			'file://{0}'.format(quote(path)) ])
-
-	if 'gconf' in conf.bg_set_methods:
-		## Gconf - older GNOME, XFCE/nautilus and such
-		try:
-			import gconf
-			gconf = gconf.client_get_default()
-			gconf.set_string(
-				'/desktop/gnome/background/picture_filename', path )
-		except ImportError: pass
-
-	if 'xfconf' in conf.bg_set_methods:
-		## Xfconf (via dbus interface) - XFCE/xfdesktop
-		try: import dbus
-		except ImportError: pass
-		else:
-			try:
-				xfconf = dbus.Interface(
-					dbus.SessionBus().get_object(
-						'org.xfce.Xfconf', '/org/xfce/Xfconf' ),
-					dbus_interface='org.xfce.Xfconf' )
-				for k,v in xfconf.GetAllProperties('xfce4-desktop', '/backdrop').iteritems():
-					if k.endswith('/image-path'): xfconf.SetProperty('xfce4-desktop', k, path)
-			except dbus.exceptions.DBusException: pass # no property/object/interface/etc
-
-	if 'enlightenment' in conf.bg_set_methods:
-		## E17+ edbus interface
-		try: import dbus
-		except ImportError: pass
-		else:
-			try:
-				edbus = dbus.SessionBus().get_object(
-						'org.enlightenment.wm.service', '/org/enlightenment/wm/RemoteObject' )
-				dxc, dyc = edbus.GetVirtualCount(dbus_interface='org.enlightenment.wm.Desktop')
-				edbus = dbus.Interface( edbus,
-					dbus_interface='org.enlightenment.wm.Desktop.Background' )
-				for dx, dy in it.product(xrange(dxc), xrange(dyc)): edbus.Add(conf.monitor, dx, dy, path)
-			except dbus.exceptions.DBusException: pass # no property/object/interface/etc
-
-	if 'x-root-window' in conf.bg_set_methods:
-		## Paint X root window via pygtk
-		pos = gtk.gdk.DisplayManager().get_default_display()\
-			.get_default_screen().get_monitor_geometry(conf.monitor)
-		pb = gtk.gdk.pixbuf_new_from_file(path)
-		pm, mask = pb.render_pixmap_and_mask()
-		win = gtk.gdk.get_default_root_window()
-		# win.set_back_pixmap(pm, False)
-		# win.clear()
-		win.draw_pixbuf(gtk.gdk.GC(win), pb, 0, 0, pos.x, pos.y, -1, -1)
+def layer_pixbuf(image, layer):
+	'Build gdk pixbuf from layer pixel data, without encoding/saving it anywhere.'
+	if not pdb.gimp_drawable_is_rgb(layer):
+		pdb.gimp_image_convert_rgb(image)
+		layer = image.active_layer
+	src = layer.get_pixel_rgn(0, 0, layer.width, layer.height, False, False)
+	return gtk.gdk.pixbuf_new_from_data( src[:,:], gtk.gdk.COLORSPACE_RGB,
+		layer.has_alpha, 8, layer.width, layer.height, layer.width * layer.bpp )
 
 
 
@@ -305,31 +693,235 @@ class PDB(object):
 pdb = PDB()
 
 
-def image_crop(image, layer):
-	'''Crop black margins from the image.
-		Done by adding a layer, making it more contrast (to drop noise on margins),
-			then cropping the layer and image to the produced layer size.'''
-	layer_guide = layer.copy()
-	pdb.gimp_image_add_layer(image, layer_guide, 1)
-	pdb.gimp_brightness_contrast(layer_guide, -30, 30)
-	pdb.plug_in_autocrop_layer(image, layer_guide) # should crop margins on layer
-	pdb.gimp_image_crop( image,
-		layer_guide.width, layer_guide.height,
-		layer_guide.offsets[0], layer_guide.offsets[1] )
-	pdb.gimp_image_remove_layer(image, layer_guide)
+def image_load(path, w=None, h=None):
+	'''Load image from path, decoding JPEG at reduced size, if it is much larger
+			than needed to cover w x h, or only needed for metadata (w=h=None), see shrink_on_load.
+		Returns (image, size) tuple, where size is original (w, h) if image was reduced, else None.'''
+	size = conf.shrink_on_load > 0 and image_header_size(path)
+	if size:
+		with open(path, 'rb') as src: jpeg = src.read(2) == b'\xff\xd8'
+		k = 0 if not w else max(float(w) / size[0], float(h) / size[1]) * conf.shrink_on_load
+		if jpeg and k <= 0.5:
+			# file-jpeg-load-thumb only returns embedded exif thumbnail, so decoding is done outside gimp
+			tmp_fd, tmp_path = mkstemp(prefix='lqr_wpset.', suffix='.ppm')
+			try:
+				os.close(tmp_fd)
+				if jpeg_decode_scaled(path, tmp_path, size, k):
+					image = pdb.gimp_file_load(tmp_path, tmp_path)
+					if image.width >= size[0] * k and image.height >= size[1] * k: return image, size
+					pdb.gimp_image_delete(image) # decoder didn't scale it as expected
+			finally: os.unlink(tmp_path)
+	return pdb.gimp_file_load(path, path), None
+
+def jpeg_decode_scaled(path, dst_path, size, k):
+	'''Decode JPEG to dst_path as PPM, downscaled by 1/2, 1/4 or 1/8 (libjpeg DCT scaling),
+			keeping at least k of (w, h) size, via PIL draft mode or djpeg binary.
+		Returns False if neither is available or decoding fails.'''
+	try: from PIL import Image
+	except ImportError: pass
+	else:
+		try:
+			img = Image.open(path)
+			img.draft('RGB', tuple(int(v * k) + 1 for v in size))
+			if img.mode not in ['RGB', 'L']: img = img.convert('RGB')
+			img.save(dst_path, 'PPM')
+		except (IOError, ValueError): return False
+		return True
+	from subprocess import call
+	scale = next(n for n in [8, 4, 2, 1] if 1.0 / n >= k)
+	try:
+		with open(os.devnull, 'wb') as devnull:
+			return call( [ 'djpeg', '-scale', '1/{}'.format(scale),
+				'-outfile', dst_path, path ], stderr=devnull ) == 0
+	except OSError: return False # no djpeg binary
+
+def image_save(image, layer, path, compression=-1):
+	'Save image to path, with specified compression level, if it is png.'
+	if path.endswith('.ppm'): # default for file-ppm-save is ascii, not raw
+		return pdb.file_ppm_save(image, layer, path, path, 1)
+	if compression < 0 or not path.endswith('.png'):
+		return pdb.gimp_file_save(image, layer, path, path)
+	pdb.file_png_save( image, layer, path, path,
+		False, compression, False, False, False, True, False )
+
+def result_path_pattern():
+	'conf.result_path with extension set according to conf.result_format.'
+	return re.sub(r'\.[^./]*$', '', conf.result_path) + '.' + conf.result_format
+
+def cache_key_path(*key):
+	'Return path in cache_dir for key tuple of values that affect rendered image.'
+	return os.path.join(conf.cache_dir, b'{0}.png'.format(
+		re.sub( r'[\n=+/]', '',
+			hashlib.sha256(b'\0'.join(map(bytes, key)))\
+				.digest().encode('base64') )[:20] ))
+
+
+def cache_key_source(path):
+	'Return tuple of values to identify source image on path in cache keys, see conf.cache_key.'
+	return ( (os.path.realpath(path), os.stat(path).st_mtime)
+		if conf.cache_key == 'path' else
+		('content', image_fingerprint(path, conf.cache_key == 'content-full')) )
+
+def cache_paths(path, w, h, flip=False):
+	'Return (cache_path, cache_path_part) for source image path and w/h it is processed for.'
+	cache_key = cache_key_source(path) + (w, h)
+	cache_path = cache_key_path(*cache_key)
+	# Scaled-to-part images have flip and all diff_w_* parameters applied
+	cache_path_part = cache_key_path(*(cache_key + ('part', flip) + tuple(
+		getattr(conf, 'diff_w_{}'.format(k)) for k in [ 'gravity', 'bg_edge',
+			'bg_solid', 'bg_solid_color', 'bg_edge_stretch',
+			'bg_edge_stretch_opacity', 'bg_edge_stretch_blur' ] )))
+	return cache_path, cache_path_part
+
+def cache_key_seams(path):
+	'Return cache key for maps of seams for source image path, or None, see conf.lqr_seams.'
+	if not (conf.cache_dir and conf.lqr_seams and conf.lqr_backend == 'numpy'): return
+	return cache_key_source(path) + ( 'seams', conf.crop_tolerance,
+		conf.lqr_rigidity, conf.lqr_delta_x, conf.lqr_levels )
+
+
+def image_crop_box(layer):
+	'''Find (x, y, w, h) box of layer without solid-color margins.
+		Lines (rows/columns) are checked inwards from each edge until one where any pixel
+			differs from color of the edge line by more than crop_tolerance, same as autocrop does,
+			using up to 1024 pixels sampled evenly from each line.
+		Margin is only cropped if pixels right inside of it are mostly different from it as well,
+			so that e.g. smooth sky or studio backdrop at the edge of the image is kept.'''
+	w, h, bpp = layer.width, layer.height, layer.bpp
+	rgn, tol = layer.get_pixel_rgn(0, 0, w, h, False, False), conf.crop_tolerance
+	chans = bpp - 1 if bpp in [2, 4] else bpp # skip alpha channel
+
+	def line_pixels(data, step):
+		px = bytearray(data)
+		return zip(*(px[n::bpp*step] for n in xrange(chans)))
+
+	def line_diff(line, color):
+		return list(max(abs(v - c) for v, c in zip(p, color)) for p in line)
+
+	def margin_size(get_line, size, length):
+		step = max(1, length // 1024)
+		line = line_pixels(get_line(0), step)
+		border = list(sum(c) // len(c) for c in zip(*line))
+		n = 0
+		while n < size and max(line_diff(line, border)) <= tol:
+			n += 1
+			if n < size: line = line_pixels(get_line(n), step)
+		if 0 < n < size:
+			diff = line_diff(line, border) # first line of content
+			if sum(diff) <= tol * len(diff): return 0
+		return n
+
+	x1 = margin_size(lambda n: rgn[n, 0:h], w, h)
+	if x1 >= w: return 0, 0, w, h # solid color image
+	x2 = w - margin_size(lambda n: rgn[w-1-n, 0:h], w, h)
+	# Margins from opposite sides can meet, e.g. solid stripe on one side with flat color elsewhere
+	if x2 <= x1: return 0, 0, w, h
+	y1 = margin_size(lambda n: rgn[x1:x2, n], h, x2 - x1)
+	y2 = h - margin_size(lambda n: rgn[x1:x2, h-1-n], h, x2 - x1)
+	if y2 <= y1: return 0, 0, w, h
+	return x1, y1, x2 - x1, y2 - y1
+
+def image_crop(image, box):
+	x, y, w, h = box
+	if (w, h) != (image.width, image.height): pdb.gimp_image_crop(image, w, h, x, y)
+
+
+def image_crop_size(image, crop_box, size=None, result=None):
+	'''Get (w, h) of crop_box in original image pixels,
+		size being original (w, h) if image was loaded at reduced size, see image_load.'''
+	crop_size = crop_box[2:]
+	if size and size[0] != image.width:
+		scale = float(size[0]) / image.width
+		crop_size = tuple(int(round(v * scale)) for v in crop_size)
+		if result is not None: result['load_scale'] = round(1 / scale, 3)
+	return crop_size
+
+def label_tags_key():
+	'Hash of label_tags and label_tags_discard, to invalidate cached tags when these change.'
+	discard = sorted( (['re', tag.pattern] if isinstance(tag, re_type)
+		else ['str', tag]) for tag in label_tags_discard )
+	return hashlib.sha256(json.dumps(
+		[list(spec[:2]) for spec in label_tags] + discard )).hexdigest()[:16]
+
+def index_image_meta(path, meta=None):
+	'''Get (original size, tags) tuple for an image from index_db, None if it's not there.
+		If meta tuple is passed, it is stored in the index instead.'''
+	db = index_db()
+	if not db: return meta
+	key = os.path.realpath(path), os.stat(path).st_mtime, label_tags_key()
+	if not meta:
+		meta = db.execute( 'select size, tags from image_meta'
+			' where path = ? and mtime = ? and tags_key = ?', key ).fetchone()
+		return meta and (meta[0].decode('utf-8'), json.loads(meta[1]))
+	with db:
+		db.execute( 'insert or replace into image_meta'
+			' values (?, ?, ?, ?, ?)', key + (meta[0], json.dumps(meta[1])) )
+	return meta
 
 
-def image_meta(path, image):
-	'Get metadata dict: image name, data from image parasite tags and/or file mtime.'
-	meta_base = { 'title': os.path.basename(path),
-		'created': datetime.fromtimestamp(os.stat(path).st_mtime),
-		'original size': '{0} x {1}'.format(*op.attrgetter('width', 'height')(image)) }
+def image_size_check(w, h, img_w, img_h, bound=False):
+	'''Check whether size/aspect difference between image and w/h isn't too great.
+		bound=True is for size that is only an upper bound for the image (e.g. before crop),
+			to only check size minimums that it can't pass otherwise, and not aspect.
+		Returns (aspects, diff_size, diff_scale) tuple or raises WPSError("next").'''
+	aspects = float(w)/h, float(img_w)/img_h
+	diff_aspect = abs(aspects[0] - aspects[1])
+	diff_size = [
+		float(img_w)/w, float(img_h)/h,
+		float(img_w * img_h) / (w*h) ]
+	diff_size_chk = list((1.0 / getattr( conf,
+		'max_size_diff_{}'.format(k) )) for k in ['w', 'h', 'area'])
+	diff_scale = False
+	if bound:
+		if diff_size[1] < diff_size_chk[1] or ( not conf.diff_w_scale_to_h
+				and any((v < chk) for v, chk in zip(diff_size, diff_size_chk)) ):
+			pdb.gimp_message(
+				( 'Max size diff (w/h/area): {:.2f}/{:.2f}/{:.2f}'
+					' (min: {:.2f}/{:.2f}/{:.2f})' ).format(*(diff_size + diff_size_chk)) )
+			raise WPSError('next', dict(reject='size'))
+	elif diff_aspect > conf.max_aspect_diff\
+			or any((v < chk) for v, chk in zip(diff_size, diff_size_chk)):
+		if not conf.diff_w_scale_to_h\
+				or diff_size[1] < diff_size_chk[1]\
+				or aspects[0] - aspects[1] < 0: # aspect_diff < 0 = too wide image
+			pdb.gimp_message(
+				( 'Aspect diff: {:.2f} (max: {:.2f}), size'
+					' diff (w/h/area): {:.2f}/{:.2f}/{:.2f} (min: {:.2f}/{:.2f}/{:.2f})' )\
+				.format(diff_aspect, conf.max_aspect_diff, *(diff_size + diff_size_chk)) )
+			raise WPSError('next', dict(
+				reject='aspect' if diff_aspect > conf.max_aspect_diff else 'size' ))
+		diff_scale = True
+	return aspects, diff_size, diff_scale
+
+
+def image_size_filter(sizes, img_size, bound=False):
+	'Return list of (w, h) sizes that image passes image_size_check for, raising its error if none.'
+	res, err = list(), None
+	for w, h in sizes:
+		try: image_size_check(w, h, *img_size, bound=bound)
+		except WPSError as err: pass
+		else: res.append((w, h))
+	if not res and err: raise err
+	return res
+
+def image_meta_tags(path, image, size=None):
+	'''Get (original size, tags) tuple for loaded image, with tags from process_tags, if any.
+		size should be original (w, h) for image loaded at reduced size, see image_load.'''
 	try: meta = pdb.gimp_image_parasite_list(image)
 	except gimp.error: meta = list() # "gimp.error: could not list parasites on image"
 	meta = process_tags(path) if set(meta)\
 			.intersection(['icc-profile', 'jpeg-settings',
 				'exif-data', 'gimp-metadata'])\
-		else dict()
+			or size else dict() # reduced-size jpeg loader doesn't add parasites
+	size = '{0} x {1}'.format(*(size or op.attrgetter('width', 'height')(image)))
+	return size, meta
+
+def image_meta(path, size, tags):
+	'Get metadata dict: image name, data from image_meta_tags and/or file mtime.'
+	meta_base = { 'title': os.path.basename(path),
+		'created': datetime.fromtimestamp(os.stat(path).st_mtime),
+		'original size': size }
+	meta = dict(tags)
 	for spec in label_tags:
 		try: label, conv = op.itemgetter(0, 2)(spec)
 		except IndexError: label, conv = spec[0], lambda x: x
@@ -390,16 +982,15 @@ def edge_blend(image, layer, a, b, d):
 		100, 0, REPEAT_NONE, False, False, 0, 0, True, ma, 0, mb, 0 )
 	pdb.gimp_layer_remove_mask(layer, MASK_APPLY)
 
-def image_rescale_to_part(image, layer, w, h, aspect):
+def image_rescale_to_part(image, layer, w, h, aspect, flip=False):
 	# Resize
 	new_size = map( lambda x: int(round(x, 0)),
 		(image.width - (image.height - h) * aspect, h) )
 	pdb.gimp_context_set_interpolation(INTERPOLATION_CUBIC)
 	pdb.gimp_image_scale(image, new_size[0], new_size[1])
 
-	# Optional flip
-	if conf.hflip_chance > 0 and random.random() < conf.hflip_chance:
-		pdb.gimp_item_transform_flip_simple(layer, ORIENTATION_HORIZONTAL, True, 0)
+	# Optional flip, done before placing image according to gravity
+	if flip: pdb.gimp_item_transform_flip_simple(layer, ORIENTATION_HORIZONTAL, True, 0)
 
 	# Scale canvas
 	a, b = 0, image.width
@@ -426,8 +1017,37 @@ def image_rescale_to_part(image, layer, w, h, aspect):
 
 	return pdb.gimp_image_flatten(image)
 
-def image_rescale(image, layer, w, h, two_pass=False):
-	'two_pass should be either False or tuple of (aspect0, aspect1)'
+def image_icc_fix(image):
+	## Try to convert color profile to a default (known-good) one, to avoid libpng errors
+	# Issue is "lcms: skipping conversion because profiles seem to be equal",
+	#  followed by "libpng error: known incorrect sRGB profile" for e.g. IEC61966-2.1
+	# See also: https://wiki.archlinux.org/index.php/Libpng_errors
+	# Requires lcms support, I think. 0 = GIMP_COLOR_RENDERING_INTENT_PERCEPTUAL
+	try:
+		pdb.plug_in_icc_profile_apply_rgb(image, 0, False) # lcms seem to skip that often
+		pdb.plug_in_icc_profile_set_rgb(image) # force-unsets profile in case of lcms being lazy
+	except gimp.error: pass # missing plugin
+
+def image_fit( image, layer, w, h, aspects,
+		diff_size, diff_scale, flip=False, result=None, seams_key=None ):
+	'''Scale cropped image to w/h via image_rescale or image_rescale_to_part (if diff_scale),
+			with aspects/diff_* values from image_size_check. Returns resulting image layer.
+		seams_key is passed to image_rescale, see cache_key_seams.'''
+	if result is None: result = dict()
+	if not diff_scale:
+		image_rescale( image, layer, w, h,
+			(diff_size[2] > conf.min_prescale_diff) and aspects, result, seams_key )
+		return layer
+	with stage(result, 'rescale_to_part'):
+		return image_rescale_to_part(image, layer, w, h, aspects[1], flip)
+
+def image_rescale(image, layer, w, h, two_pass=False, result=None, seams_key=None):
+	'''two_pass should be either False or tuple of (aspect0, aspect1).
+		seams_key enables storing/re-using maps of seams in cache_dir, see image_lqr_seams.
+		Times of prescale/lqr stages are added to result dict, if passed.'''
+	if result is None: result = dict()
+	if seams_key:
+		return image_lqr_seams(image, layer, w, h, seams_key, result)
 	if two_pass:
 		# Pre-LQR rescaling, preserving aspect
 		# Improves quality and saves a lot of jiffies
@@ -436,62 +1056,147 @@ def image_rescale(image, layer, w, h, two_pass=False):
 			(image.width - (image.height - h) * aspects[1], h)\
 			if aspects[1] > aspects[0] else\
 			(w, image.height - (image.width - w) / aspects[0]) )
-		pdb.gimp_context_set_interpolation(INTERPOLATION_CUBIC)
-		pdb.gimp_image_scale(image, new_size[0], new_size[1])
-	# All but the first 4 parameters are defaults, taken from batch-gimp-lqr.scm
+		with stage(result, 'prescale'):
+			pdb.gimp_context_set_interpolation(INTERPOLATION_CUBIC)
+			pdb.gimp_image_scale(image, new_size[0], new_size[1])
+	with stage(result, 'lqr'): lqr_backends[conf.lqr_backend](image, layer, w, h)
+
+def image_lqr_gimp(image, layer, w, h):
+	# All but the first 4 and lqr_* parameters are defaults, taken from batch-gimp-lqr.scm
+	# Energy function (nrg_func=3 - luma gradient norm) is same as in lqr_numpy
 	pdb.plug_in_lqr( image, layer, w, h,
-		0, 1000, 0, 1000, 0, 0, 1, 150, 1, 1, 0, 0, 3, 0, 0, 0, 0, 1, '', '', '', '' )
-
-
-def image_add_label(image, layer_image, meta):
-	## Render label on top of the image layer
-	# First, render all the the text boxes
+		0, 1000, 0, 1000, conf.lqr_rigidity, 0, conf.lqr_delta_x,
+		150, 1, 1, 0, 0, 3, conf.lqr_res_order, 0, 0, 0, 1, '', '', '', '' )
+
+def image_lqr_numpy(image, layer, w, h):
+	import lqr_numpy
+	layer_array_set(image, layer, lqr_numpy.rescale( layer_array(layer), w, h,
+		conf.lqr_rigidity, conf.lqr_delta_x, conf.lqr_res_order, conf.lqr_levels ))
+
+lqr_backends = dict(gimp=image_lqr_gimp, numpy=image_lqr_numpy)
+
+def layer_array(layer):
+	'Return (h, w, bpp) numpy array with pixel data of the layer.'
+	import numpy as np
+	src = layer.get_pixel_rgn(0, 0, layer.width, layer.height, False, False)
+	return np.frombuffer(src[:,:], dtype=np.uint8)\
+		.reshape(layer.height, layer.width, layer.bpp)
+
+def layer_array_set(image, layer, img):
+	'Resize image and layer to size of (h, w, bpp) numpy array, replacing layer pixel data with it.'
+	h, w = img.shape[:2]
+	pdb.gimp_image_resize(image, w, h, 0, 0)
+	pdb.gimp_layer_resize(layer, w, h, 0, 0)
+	dst = layer.get_pixel_rgn(0, 0, w, h, True, True)
+	dst[:,:] = img.tostring()
+	layer.flush()
+	layer.merge_shadow(True)
+	layer.update(0, 0, w, h)
+
+def image_lqr_seams(image, layer, w, h, seams_key, result):
+	'''Liquid-rescale image to w/h with numpy backend, storing map of seams for it in cache_dir,
+			or re-using one from there, with seams_key and whether rows or columns are removed,
+			if it has enough seams for the new aspect ratio.
+		Map is built for image prescaled to only need rows or columns removed, with lqr_seams_extra,
+			and re-used by prescaling image to same size, removing seams, then scaling it to w/h.
+		Adds "seams" (hit/miss) to result dict, as well as prescale/lqr or lqr_seams stage times.'''
+	import numpy as np, lqr_numpy
+	# Map is stored transposed for removing rows (axis=1), same as in lqr_numpy.rescale
+	aspects = float(w) / h, float(image.width) / image.height
+	axis, vmap = int(aspects[1] <= aspects[0]), None
+	seams_path = cache_key_path(*(seams_key + (axis,)))[:-4] + '.npz'
+	try:
+		src = np.load(seams_path)
+		try: vmap, n = src['vmap'], int(src['n'])
+		finally: src.close()
+	except (OSError, IOError, KeyError, ValueError): pass # missing or evicted
+
+	if vmap is not None:
+		h0, w0 = vmap.shape
+		wc = int(round(h0 * (aspects[0] if not axis else 1 / aspects[0])))
+		scale = float([h, w][axis]) / h0
+		if not w0 - n <= wc <= w0\
+				or (scale > conf.lqr_seams_max_scale and h0 < [image.height, image.width][axis]):
+			vmap = None
+	if vmap is not None:
+		with stage(result, 'lqr_seams'):
+			pdb.gimp_context_set_interpolation(INTERPOLATION_CUBIC)
+			pdb.gimp_image_scale(image, *([w0, h0] if not axis else [h0, w0]))
+			img = layer_array(layer)
+			if axis: img = img.transpose(1, 0, 2)
+			img = lqr_numpy.carve_vmap(img, vmap, wc)
+			layer_array_set(image, layer, img if not axis else img.transpose(1, 0, 2))
+			pdb.gimp_image_scale(image, w, h)
+		cache_hit(seams_path, count=False)
+		result['seams'] = 'hit'
+		return
+
+	with stage(result, 'prescale'):
+		pdb.gimp_context_set_interpolation(INTERPOLATION_CUBIC)
+		pdb.gimp_image_scale(image, *( (int(round(h * aspects[1])), h)
+			if not axis else (w, int(round(w / aspects[1]))) ))
+	with stage(result, 'lqr'):
+		img = layer_array(layer)
+		if axis: img = img.transpose(1, 0, 2)
+		w0, wc = img.shape[1], [w, h][axis]
+		n = min(w0 - 1, w0 - wc + int(w0 * conf.lqr_seams_extra))
+		vmap = lqr_numpy.carve_w( img, w0 - n,
+			conf.lqr_rigidity, conf.lqr_delta_x, conf.lqr_levels, vmap=True )[1]
+		img = lqr_numpy.carve_vmap(img, vmap, wc)
+		layer_array_set(image, layer, img if not axis else img.transpose(1, 0, 2))
+	with stage(result, 'save_seams'):
+		seams_path_tmp = '{}.{}.tmp'.format(seams_path, os.getpid())
+		with open(seams_path_tmp, 'wb') as dst:
+			np.savez_compressed( dst, n=n,
+				vmap=vmap.astype(np.uint16 if w0 < 2**16 else np.int32) )
+		os.rename(seams_path_tmp, seams_path) # other workers can load it concurrently
+		cache_add(seams_path)
+	result['seams'] = 'miss'
+
+
+def label_tile(title, meta, offset_y=None):
+	'''Render label with outline into a new RGBA image, bounded tightly around it,
+			with (0, 0) of that image corresponding to label_origin() on the background.
+		If title is None, only tags are rendered, starting at offset_y on the background.
+		Returns (image, layer) tuple, image should be deleted by the caller.'''
+	image = pdb.gimp_image_new(1, 1, RGB)
+	# First, render all the the text boxes as new layers
 	# Image title, larger than the rest of the tags
-	label_title = pdb.gimp_text_fontname( image, layer_image,
-		conf.label_offset[0], conf.label_offset[1], meta.pop('title'),
-		-1, True, conf.font_filename[1], PIXELS, conf.font_filename[0] )
-	pdb.gimp_floating_sel_to_layer(label_title)
-	# Tags, ordered according to label_tags
-	meta = list( (label, meta.pop(label))
-		for label in it.imap(op.itemgetter(0), label_tags)
-		if label in meta ) + list(meta.iteritems())
 	offset_layer = 0.5 * conf.font_timestamp[1]
-	offset_y = label_title.offsets[1] + label_title.height + offset_layer
-	label_keys = pdb.gimp_text_fontname( image, layer_image,
-		label_title.offsets[1] + 3 * conf.font_timestamp[1], offset_y,
+	label_layers = list()
+	if title is not None:
+		label_title = pdb.gimp_text_fontname( image, None,
+			conf.label_offset[0], conf.label_offset[1], title,
+			-1, True, conf.font_filename[1], PIXELS, conf.font_filename[0] )
+		offset_y = label_title.offsets[1] + label_title.height + offset_layer
+		label_layers.append(label_title)
+	label_keys = pdb.gimp_text_fontname( image, None,
+		conf.label_offset[1] + 3 * conf.font_timestamp[1], offset_y,
 		'\n'.join(it.imap(op.itemgetter(0), meta)),
 		-1, True, conf.font_timestamp[1], PIXELS, conf.font_timestamp[0] )
-	pdb.gimp_floating_sel_to_layer(label_keys)
-	label_vals = pdb.gimp_text_fontname( image, layer_image,
+	label_vals = pdb.gimp_text_fontname( image, None,
 		label_keys.offsets[0] + label_keys.width + offset_layer, offset_y,
 		'\n'.join(it.imap(op.itemgetter(1), meta)),
 		-1, True, conf.font_timestamp[1], PIXELS, conf.font_timestamp[0] )
-	pdb.gimp_floating_sel_to_layer(label_vals)
-	label_layers = label_title, label_keys, label_vals
-
-	# Find average color within the label_geom box
-	#  and pick the most distant color from label_colors
-	label_geom = tuple(( layer.offsets + op.attrgetter(
-		'width', 'height')(layer) ) for layer in label_layers)
-	label_geom = tuple(conf.label_offset) + tuple( # (offsets + dimensions)
-		max((g[i] + g[2+i] - conf.label_offset[i]) for g in geoms)
-		for i,geoms in enumerate([label_geom]*2) )
-	pdb.gimp_context_set_feather(False)
-	pdb.gimp_context_set_feather_radius(0, 0)
-	pdb.gimp_image_select_rectangle(
-		image, CHANNEL_OP_REPLACE,
-		label_geom[0], label_geom[1],
-		label_geom[2], label_geom[3] )
+	label_layers.extend([label_keys, label_vals])
+
+	# Resize canvas to fit all text boxes and outlines around them
+	x0, y0 = label_origin()
+	x1 = max(layer.offsets[0] + layer.width for layer in label_layers) + label_pad
+	y1 = max(layer.offsets[1] + layer.height for layer in label_layers) + label_pad
+	pdb.gimp_image_resize(image, x1 - x0, y1 - y0, -x0, -y0)
+
 	pdb.gimp_context_set_foreground(conf.label_colors[0])
 	pdb.gimp_context_set_background(conf.label_colors[1])
 	pdb.gimp_context_set_antialias(True)
 	pdb.gimp_context_set_feather(True)
+	pdb.gimp_context_set_feather_radius(0, 0)
 	# Set the picked color for all label layers, draw outlines
 	label_outline = pdb.gimp_layer_new(
 		image, image.width, image.height, RGBA_IMAGE,
 		'label_outline', conf.label_outline_opacity, NORMAL_MODE )
-	pdb.gimp_image_add_layer(
-		image, label_outline, image.layers.index(layer_image) )
+	pdb.gimp_image_add_layer(image, label_outline, len(label_layers))
+	pdb.gimp_drawable_fill(label_outline, TRANSPARENT_FILL)
 	for layer in label_layers:
 		pdb.gimp_text_layer_set_color(layer, conf.label_colors[0])
 		path = pdb.gimp_vectors_new_from_text_layer(image, layer)
@@ -500,120 +1205,448 @@ def image_add_label(image, layer_image, meta):
 		pdb.gimp_selection_grow(image, 1)
 		pdb.gimp_edit_fill(label_outline, BACKGROUND_FILL)
 
+	return image, pdb.gimp_image_merge_visible_layers(image, CLIP_TO_IMAGE)
+
+label_pad = 2 # px around text boxes in label tile, for 1px outline with antialiasing
+
+def label_origin():
+	return tuple(max(0, conf.label_offset[i] - label_pad) for i in xrange(2))
+
+def image_add_label(image, layer_image, meta):
+	'''Render label on top of the image layer, returning new flattened layer.
+		Label is rendered separately (see label_tile) and composited onto image,
+			with these tiles cached by text and all label parameters in cache_dir, if enabled.
+		label_tags_volatile are rendered into a separate uncached tile under the cached one.'''
+	title = meta.pop('title')
+	# Tags, ordered according to label_tags
+	meta = list( (label, meta.pop(label))
+		for label in it.imap(op.itemgetter(0), label_tags)
+		if label in meta ) + list(meta.iteritems())
+	meta, meta_volatile = (
+		list(kv for kv in meta if (kv[0] in label_tags_volatile) == volatile)
+		for volatile in [False, True] )
+
+	tile_path = conf.cache_dir and cache_key_path('label', json.dumps([ title, meta,
+		conf.label_offset, list(list(c) for c in conf.label_colors),
+		conf.label_outline_opacity, conf.font_filename, conf.font_timestamp ]))
+	if tile_path and os.path.exists(tile_path):
+		layer = pdb.gimp_file_load_layer(image, tile_path)
+		cache_hit(tile_path, count=False)
+	else:
+		tile, layer = label_tile(title, meta)
+		try:
+			if tile_path:
+				image_save(tile, layer, tile_path, conf.cache_compression)
+				cache_add(tile_path)
+			layer = pdb.gimp_layer_new_from_drawable(layer, image)
+		finally: pdb.gimp_image_delete(tile)
+	layers = [layer]
+	if meta_volatile:
+		tile, layer = label_tile( None, meta_volatile,
+			label_origin()[1] + layer.height - label_pad )
+		try: layers.append(pdb.gimp_layer_new_from_drawable(layer, image))
+		finally: pdb.gimp_image_delete(tile)
+	for layer in layers:
+		pdb.gimp_image_add_layer(image, layer, image.layers.index(layer_image))
+		pdb.gimp_layer_set_offsets(layer, *label_origin())
+
 	# Meld all the layers together, return new "image" layer
 	return pdb.gimp_image_flatten(image)
 
 
-def lqr_wpset(path):
+def monitor_sizes():
+	'Sorted list of distinct (w, h) sizes of all monitors, or just monitor_size, if set.'
+	if conf.monitor_size: return [tuple(map(int, conf.monitor_size.split('x', 1)))]
+	screen = gtk.gdk.DisplayManager().get_default_display().get_default_screen()
+	return sorted(set( (geom.width, geom.height) for geom in
+		it.imap(screen.get_monitor_geometry, xrange(screen.get_n_monitors())) ))
+
+def image_cache(path, image, crop_size, sizes, result):
+	'''Process cropped image into cache_dir for each of (w, h) sizes, using a copy of it for each one,
+			and skipping sizes that are already cached or don't pass image_size_check.
+		Times of processing stages for all sizes are added up in result dict.'''
+	for w, h in sizes:
+		cache_path, cache_path_part = cache_paths(path, w, h)
+		if os.path.exists(cache_path) or os.path.exists(cache_path_part): continue
+		try: aspects, diff_size, diff_scale = image_size_check(w, h, *crop_size)
+		except WPSError: continue
+		if diff_scale: cache_path = cache_path_part
+		image_copy = pdb.gimp_image_duplicate(image)
+		try:
+			layer = image_fit( image_copy, image_copy.active_layer, w, h, aspects,
+				diff_size, diff_scale, result=result, seams_key=cache_key_seams(path) )
+			with stage(result, 'save'):
+				image_save(image_copy, layer, cache_path, conf.cache_compression)
+				result['bytes'] = result.get('bytes', 0) + cache_add(cache_path)
+		finally: pdb.gimp_image_delete(image_copy)
+
+def wpset(path, mode='set'):
+	'''Process image from path and set it as a background.
+		mode="render" only saves final image to result_path, returning its path in the result,
+			to be set as a background later via wpset_apply, possibly with other monitors at once.
+			With x-root-window as the only bg_set_methods, image is kept in memory instead (see pixbufs).
+		mode="prerender" saves processed image (without label) to conf.prerender_path.
+		With cache_all_monitors enabled, uncached image is also processed into cache_dir
+			for geometries of all other monitors, from same decoded/cropped image (see image_cache).
+		Returns dict with info on what was done, e.g. cache hit/miss and stats,
+			as well as wall time and peak RSS during each processing stage (see stage function).'''
 	random.seed()
+	prerender, result = mode == 'prerender', dict()
+	flip = conf.hflip_chance > 0 and random.random() < conf.hflip_chance
 
-	dsp = gtk.gdk.DisplayManager().get_default_display()\
-		.get_default_screen().get_monitor_geometry(conf.monitor)
-	w, h = dsp.width, dsp.height
-
-	path_source, cache_path, cached = path, None, False
-	if conf.cache_dir:
-		cache_key = os.path.realpath(path), os.stat(path).st_mtime, w, h
-		cache_path = os.path.join(conf.cache_dir, b'{0}.png'.format(
-			re.sub( r'[\n=+/]', '',
-				hashlib.sha256(b'\0'.join(map(bytes, cache_key)))\
-					.digest().encode('base64') )[:20] ))
-		if not conf.recache and os.path.exists(cache_path):
-			path_source, cached = cache_path, True
-
-	try: image = pdb.gimp_file_load(path_source, path_source)
-	except RuntimeError: # failed to load - e.g. corrupted file
-		cached, image = False, pdb.gimp_file_load(path, path)
-	image_orig = image if not cached else pdb.gimp_file_load(path, path)
+	if conf.monitor_size: w, h = map(int, conf.monitor_size.split('x', 1))
+	else:
+		dsp = gtk.gdk.DisplayManager().get_default_display()\
+			.get_default_screen().get_monitor_geometry(conf.monitor)
+		w, h = dsp.width, dsp.height
+
+	path_source, cached, diff_scale = path, False, False
+	cache_path = cache_path_part = None
+	if conf.prerender_path and not prerender:
+		path_source, cached, flip = conf.prerender_path, True, False # flipped in prerender
+	elif conf.cache_dir:
+		cache_path, cache_path_part = cache_paths(path, w, h, flip)
+		if not conf.recache:
+			if os.path.exists(cache_path): path_source, cached = cache_path, True
+			else:
+				# Flip is random, so scaled-to-part image with either one is fine, if both are allowed
+				parts = [(flip, cache_path_part)]
+				if 0 < conf.hflip_chance < 1: parts.append((not flip, cache_paths(path, w, h, not flip)[1]))
+				for flip_part, path_part in parts:
+					if not os.path.exists(path_part): continue
+					path_source = cache_path = cache_path_part = path_part
+					cached = diff_scale = True
+					flip = flip_part
+					break
+		cache_hit(cache_path if cached else None)
+		result.update(('cache_{}'.format(k), v) for k,v in cache_stats().viewitems())
+		result['cache'] = 'hit' if cached else 'miss'
+		if prerender and cached and (diff_scale or not flip):
+			shutil.copyfile(cache_path, conf.prerender_path)
+			return result
+
+	if not cached:
+		## Check size from index/header before decoding whole image
+		with stage(result, 'check'):
+			img_size, cropped = index_image_size(path)
+			if img_size: image_size_check(w, h, *img_size, bound=not cropped)
+
+	## Decoded image should be large enough for all geometries it gets processed for
+	sizes_other = list( s for s in monitor_sizes() if s != (w, h) )\
+		if not cached and cache_path and conf.cache_all_monitors else list()
+	load_size = map(max, zip((w, h), *sizes_other))
+
+	with stage(result, 'load'):
+		try:
+			if not cached: image, size = image_load(path, *load_size)
+			else: image, size = pdb.gimp_file_load(path_source, path_source), None
+		except RuntimeError: # failed to load - e.g. corrupted file
+			cached, (image, size) = False, image_load(path, *load_size)
+		## Original image is only needed for tags/size, if these are not in index_db
+		meta = index_image_meta(path)
+		image_orig, size_orig = (image, size) if not cached else\
+			(image_load(path) if not meta else (None, None))
 
 	layer_image = image.active_layer
 	bak_colors = pdb.gimp_context_get_foreground(), pdb.gimp_context_get_background()
-	diff_scale = False
 	try:
+		if not meta:
+			with stage(result, 'meta'):
+				meta = index_image_meta(path, image_meta_tags(path, image_orig, size_orig))
 		if not cached:
-			image_crop(image, layer_image)
-
-			## Check whether size/aspect difference isn't too great
-			aspects = float(w)/h, float(image.width)/image.height
-			diff_aspect = abs(aspects[0] - aspects[1])
-			diff_size = [
-				float(image.width)/w, float(image.height)/h,
-				float(image.width * image.height) / (w*h) ]
-			diff_size_chk = list((1.0 / getattr( conf,
-				'max_size_diff_{}'.format(k) )) for k in ['w', 'h', 'area'])
-			if diff_aspect > conf.max_aspect_diff\
-					or any((v < chk) for v, chk in zip(diff_size, diff_size_chk)):
-				if not conf.diff_w_scale_to_h\
-						or diff_size[1] < diff_size_chk[1]\
-						or aspects[0] - aspects[1] < 0: # aspect_diff < 0 = too wide image
-					pdb.gimp_message(
-						( 'Aspect diff: {:.2f} (max: {:.2f}), size'
-							' diff (w/h/area): {:.2f}/{:.2f}/{:.2f} (min: {:.2f}/{:.2f}/{:.2f})' )\
-						.format(diff_aspect, conf.max_aspect_diff, *(diff_size + diff_size_chk)) )
-					pdb.gimp_message('WPS-ERR:next')
-					return
-				diff_scale, cache_path = True, None
-
-		meta = image_meta(path, image_orig)
+			with stage(result, 'crop'):
+				crop_box = image_crop_box(layer_image)
+				crop_size = image_crop_size(image, crop_box, size, result)
+				index_image_size(path, crop_size)
+				aspects, diff_size, diff_scale = image_size_check(w, h, *crop_size)
+				image_crop(image, crop_box)
+			if diff_scale: cache_path, result['diff_scale'] = cache_path_part, True
+
+		if not prerender: meta = image_meta(path, *meta)
 
 		if not cached:
-			## Try to convert color profile to a default (known-good) one, to avoid libpng errors
-			# Issue is "lcms: skipping conversion because profiles seem to be equal",
-			#  followed by "libpng error: known incorrect sRGB profile" for e.g. IEC61966-2.1
-			# See also: https://wiki.archlinux.org/index.php/Libpng_errors
-			# Requires lcms support, I think. 0 = GIMP_COLOR_RENDERING_INTENT_PERCEPTUAL
-			try:
-				pdb.plug_in_icc_profile_apply_rgb(image, 0, False) # lcms seem to skip that often
-				pdb.plug_in_icc_profile_set_rgb(image) # force-unsets profile in case of lcms being lazy
-			except gimp.error: pass # missing plugin
+			with stage(result, 'icc'): image_icc_fix(image)
 
-			if not diff_scale:
-				image_rescale( image, layer_image, w, h,
-					(diff_size[2] > conf.min_prescale_diff) and aspects )
-			else:
-				layer_image = image_rescale_to_part(image, layer_image, w, h, aspects[1])
+			if sizes_other:
+				with stage(result, 'cache_monitors'):
+					image_cache(path, image, crop_size, sizes_other, dict())
+
+			layer_image = image_fit( image, layer_image, w, h, aspects,
+				diff_size, diff_scale, flip, result, cache_key_seams(path) )
 
 			if cache_path:
-				pdb.gimp_file_save(image, layer_image, cache_path, cache_path)
+				with stage(result, 'save'):
+					image_save(image, layer_image, cache_path, conf.cache_compression)
+					result['bytes'] = result.get('bytes', 0) + cache_add(cache_path)
 
 		## Do the random horizontal flip of the image layer, if specified
-		if not diff_scale and conf.hflip_chance > 0 and random.random() < conf.hflip_chance:
+		if flip and not diff_scale: # scaled-to-part images are flipped before placement
 			pdb.gimp_item_transform_flip_simple(
 				layer_image, ORIENTATION_HORIZONTAL, True, 0 )
 
-		layer_image = image_add_label(image, layer_image, meta)
-
-		## Save image to a temporary file and set it as a bg, cleanup older images
-		pat = conf.result_path.format(monitor=conf.monitor, id='*')
-		old_files, (prefix, suffix) = glob.glob(pat), pat.split('*', 1)
-		tmp_dir, prefix = prefix.rsplit('/', 1)
-		fd, tmp_file_path = mkstemp(prefix=prefix, suffix=suffix, dir=tmp_dir)
-		pdb.gimp_file_save(image, layer_image, tmp_file_path, tmp_file_path)
-		set_background_from_file(tmp_file_path)
-		os.close(fd)
-		for tmp_file_path in old_files:
-			with open(tmp_file_path, 'wb'): pass # truncate files first, in case something holds open fd
-			os.unlink(tmp_file_path)
+		if prerender:
+			with stage(result, 'save'):
+				image_save( image, layer_image,
+					conf.prerender_path, conf.result_compression )
+			result['bytes'] = result.get('bytes', 0) + os.stat(conf.prerender_path).st_size
+			return result
+
+		with stage(result, 'label'):
+			layer_image = image_add_label(image, layer_image, meta)
+
+		if not set(conf.bg_set_methods).intersection(bg_set_methods_file):
+			## Keep pixel data in memory for x-root-window, as there's no need for a file
+			with stage(result, 'pixbuf'):
+				tmp_file_path = 'pixbuf:{}:{}'.format(conf.monitor, os.urandom(6).encode('hex'))
+				pixbufs[conf.monitor] = tmp_file_path, layer_pixbuf(image, layer_image)
+		else:
+			## Save image to a temporary file
+			with stage(result, 'save'):
+				prefix, suffix = result_path_pattern().format(monitor=conf.monitor, id='*').split('*', 1)
+				tmp_dir, prefix = prefix.rsplit('/', 1)
+				fd, tmp_file_path = mkstemp(prefix=prefix, suffix=suffix, dir=tmp_dir)
+				os.close(fd)
+				image_save(image, layer_image, tmp_file_path, conf.result_compression)
+			result['bytes'] = result.get('bytes', 0) + os.stat(tmp_file_path).st_size
+		## Set it as a bg, unless only rendering it
+		if mode == 'render': result['path'] = tmp_file_path
+		else: wpset_apply(tmp_file_path, result)
 
 	finally:
 		## Restore gimp state
 		pdb.gimp_image_delete(image)
+		if image_orig is not None and image_orig is not image: pdb.gimp_image_delete(image_orig)
 		pdb.gimp_context_set_foreground(bak_colors[0])
 		pdb.gimp_context_set_background(bak_colors[1])
 
-	## Cache cleanup
-	if conf.cache_dir and random.random() < (conf.cache_cleanup / 100.0):
-		files = list()
-		for p in map(ft.partial(os.path.join, conf.cache_dir), os.listdir(conf.cache_dir)):
-			try: s = os.stat(p)
-			except (OSError, IOError):
-				pdb.gimp_message('WPS-WARN: Unable to access cache path: {!r}'.format(p))
-				continue
-			files.append((s.st_mtime, s.st_size, p))
-		files = sorted(files, reverse=True)
-		while files and sum(map(op.itemgetter(1), files)) > conf.cache_size:
-			mtime, size, p = files.pop() # oldest one
-			os.unlink(p)
+	return result
+
+def wpset_apply(path, result=None):
+	'''Set already rendered image from path as a background, removing older ones for same monitor.
+		Path can also be "pixbuf:..." id of image rendered by same process, see pixbufs.
+		Returns result dict with time it took, same as wpset.'''
+	if result is None: result = dict()
+	old_files = set(glob.glob(result_path_pattern().format(monitor=conf.monitor, id='*')))
+	with stage(result, 'apply'):
+		if not path.startswith('pixbuf:'): set_background_from_file(path, result)
+		else:
+			pb_id, pb = pixbufs.pop(conf.monitor, (None, None))
+			if pb_id != path: raise WPSError('pixbuf_missing')
+			set_background_root_window(pb)
+	for tmp_file_path in old_files.difference([path]):
+		with open(tmp_file_path, 'wb'): pass # truncate files first, in case something holds open fd
+		os.unlink(tmp_file_path)
+	return result
+
+
+def lqr_wpset(path):
+	try: wpset(path)
+	except WPSError as err: pdb.gimp_message('WPS-ERR:{}'.format(err))
+
+
+def wpset_cache(path):
+	'''Process image from path into cache_dir for each distinct monitor geometry,
+			decoding and cropping it only once, and skipping sizes that are already cached.
+		Used to pre-fill cache for whole image collections, see --prerender in aura.sh.
+		Raises WPSError("cache_full") when cache_dir is already at cache_size,
+			or new files don't fit there with cache_evict=none, which --prerender uses,
+			or WPSError("next") if image was rejected for all geometries, or before (via index_db).
+		Result has cache=hit only if image was already cached for all geometries.'''
+	if not conf.cache_dir: raise WPSError('no_cache')
+	result, sizes = dict(cache='hit'), monitor_sizes()
+	sizes = list( (w, h) for w, h in sizes
+		if not any(it.imap(os.path.exists, cache_paths(path, w, h))) )
+	if not sizes: return result
+	result['cache'] = 'miss'
+	if cache_stats().get('size', 0) >= conf.cache_size: raise WPSError('cache_full')
+
+	with stage(result, 'check'):
+		img_size, cropped = index_image_size(path)
+		if img_size: sizes = image_size_filter(sizes, img_size, not cropped)
+	with stage(result, 'load'): image, size = image_load(path, *map(max, zip(*sizes)))
+	bak_colors = pdb.gimp_context_get_foreground(), pdb.gimp_context_get_background()
+	try:
+		if not index_image_meta(path):
+			with stage(result, 'meta'): index_image_meta(path, image_meta_tags(path, image, size))
+		with stage(result, 'crop'):
+			crop_box = image_crop_box(image.active_layer)
+			crop_size = image_crop_size(image, crop_box, size, result)
+			index_image_size(path, crop_size)
+			sizes = image_size_filter(sizes, crop_size)
+			image_crop(image, crop_box)
+		with stage(result, 'icc'): image_icc_fix(image)
+		image_cache(path, image, crop_size, sizes, result)
+	finally:
+		pdb.gimp_image_delete(image)
+		pdb.gimp_context_set_foreground(bak_colors[0])
+		pdb.gimp_context_set_background(bak_colors[1])
+	return result
+
+wpset_cmds = dict( set=wpset, apply=wpset_apply, cache=wpset_cache,
+	render=ft.partial(wpset, mode='render'), prerender=ft.partial(wpset, mode='prerender') )
+
+def lqr_wpset_worker(path_req, path_res):
+	'''Persistent worker mode, to avoid gimp startup delays for every processed image.
+		Reads jobs from path_req (fifo or file) until EOF, one per line,
+			each line being tab-separated command (see wpset_cmds), image path
+			and any number of key=value conf overrides, e.g. "set\tfile.jpg\tmonitor=1".
+		Writes one result line per job to path_res, same tab-separated format -
+			"WPS-OK" or "WPS-ERR:<code>", followed by key=value result info,
+			which always includes total job time, and times of processing stages, if any.'''
+	global conf
+	import traceback
+	with open(path_req, 'rb') as src, open(path_res, 'wb', 0) as dst:
+		for line in iter(src.readline, b''):
+			line = line.rstrip(b'\n')
+			if not line: continue
+			res, info, ts = 'WPS-OK', dict(), time.time()
+			# Monitor geometry is only updated by gtk when RandR events are processed
+			while gtk.events_pending(): gtk.main_iteration(False)
+			try:
+				cmd, path, opts = (lambda cmd, path, *opts: (cmd, path, opts))(*line.split(b'\t'))
+				conf = conf_init(dict(opt.split(b'=', 1) for opt in opts))
+				info = wpset_cmds[cmd](path) or info
+			except WPSError as err: res, info = 'WPS-ERR:{}'.format(err), err.info
+			except Exception as err:
+				pdb.gimp_message('WPS-WARN: Job failed ({!r}): {}'.format(line, traceback.format_exc()))
+				res = 'WPS-ERR:gimp_error'
+			info['time'] = round(time.time() - ts, 3)
+			info = list( '{}={}'.format(k, v.decode('utf-8', 'replace')
+				if isinstance(v, bytes) else v) for k,v in sorted(info.viewitems()) )
+			dst.write('\t'.join([res] + info).encode('utf-8') + b'\n')
+
+
+# Synthetic images for lqr_wpset_bench: name, w, h, solid margin size, whether to add exif tags
+bench_corpus = [
+	('fhd', 1920, 1080, 0, False), ('4k', 3840, 2160, 0, False),
+	('small', 1024, 768, 0, False), ('portrait', 1200, 1800, 0, False),
+	('panorama', 6000, 1600, 0, False), ('margins', 2400, 1600, 160, False),
+	('exif', 2048, 1365, 0, True) ]
+bench_geometries = ['1920x1080', '1920x1200', '2560x1440', '3840x2160']
+bench_rounds = 2 # all rounds after first one should hit cache
+
+def bench_corpus_image(path, w, h, margin, exif):
+	'Create deterministic noise image with optional solid margin and exif tags.'
+	image = pdb.gimp_image_new(w, h, RGB)
+	layer = pdb.gimp_layer_new(image, w, h, RGB_IMAGE, 'bg', 100.0, NORMAL_MODE)
+	pdb.gimp_image_add_layer(image, layer, 0)
+	pdb.plug_in_plasma(image, layer, w * h % 2**31, 2.0)
+	if margin:
+		pdb.gimp_image_resize(image, w + 2*margin, h + 2*margin, margin, margin)
+		pdb.gimp_context_set_background((0, 0, 0))
+		layer = pdb.gimp_image_flatten(image)
+	pdb.gimp_file_save(image, layer, path, path)
+	pdb.gimp_image_delete(image)
+	if not exif: return
+	try: import pyexiv2
+	except ImportError: return pdb.gimp_message('WPS-WARN: No pyexiv2 to add exif tags')
+	meta = pyexiv2.ImageMetadata(path)
+	meta.read()
+	for k, v in [ ('Exif.Image.Artist', 'Benchmark'), ('Exif.Image.Make', 'Camera'),
+			('Exif.Image.ImageDescription', 'Synthetic image ' * 64),
+			('Exif.Image.DateTime', datetime(2018, 1, 1)),
+			('Exif.Photo.UserComment', 'x' * 2**16) ]: meta[k] = v
+	meta.write()
+
+def bench_lqr_backends(paths, size):
+	'''Compare lqr_backends on images from (name, path) list, for WxH size string,
+			with same prescaling as in image_rescale, but without crop or other steps.
+		Returns list of dicts with lqr time (or "unavailable") for each backend per image,
+			and mean absolute difference of pixel values between their results, if numpy is available.'''
+	global conf
+	conf_bench, runs = conf, list()
+	w, h = map(int, size.split('x', 1))
+	try:
+		for name, path in paths:
+			image = pdb.gimp_file_load(path, path)
+			try:
+				try: aspects, diff_size, diff_scale = image_size_check(w, h, image.width, image.height)
+				except WPSError: continue
+				if diff_scale: continue # no lqr for these
+				run, pixels = dict(image=name, size=size), dict()
+				for backend in sorted(lqr_backends):
+					conf = conf_init(dict(lqr_backend=backend, lqr_seams=''))
+					image_copy, result = pdb.gimp_image_duplicate(image), dict()
+					try:
+						layer = image_copy.active_layer
+						image_rescale( image_copy, layer, w, h,
+							(diff_size[2] > conf.min_prescale_diff) and aspects, result )
+						run[backend] = result['time_lqr']
+						try: pixels[backend] = layer_array(layer).astype('int16')
+						except ImportError: pass
+					except (AttributeError, ImportError, gimp.error): # no plugin or numpy
+						run[backend] = 'unavailable'
+					finally: pdb.gimp_image_delete(image_copy)
+				if len(pixels) == 2:
+					a, b = pixels.values()
+					if a.shape == b.shape: run['diff'] = round(float(abs(a - b).mean()), 2)
+				runs.append(run)
+			finally: pdb.gimp_image_delete(image)
+	finally: conf = conf_bench
+	return runs
+
+def lqr_wpset_bench(corpus_dir, path_res):
+	'''Benchmark pipeline stages on synthetic images (see bench_corpus),
+			generated in corpus_dir if missing there, for each of bench_geometries.
+		Writes JSON with times/RSS of stages and cache hit for each run, plus totals, to path_res.
+		With lqr_seams, lqr vs lqr_seams stage totals show time saved by re-using seams maps.
+		Also includes comparison of lqr backends for the largest geometry, see bench_lqr_backends.
+		Background is not set, and cache/index dbs are created in a temp dir.'''
+	global conf
+	import traceback
+	conf_bench, runs, tmp_dir = conf, list(), mkdtemp(prefix='lqr_wpset_bench.')
+	try:
+		if not os.path.isdir(corpus_dir): os.makedirs(corpus_dir)
+		paths = list()
+		for name, w, h, margin, exif in bench_corpus:
+			path = os.path.join(corpus_dir, 'bench_{}.jpg'.format(name))
+			if not os.path.exists(path): bench_corpus_image(path, w, h, margin, exif)
+			paths.append((name, path))
+		os.mkdir(os.path.join(tmp_dir, 'cache'))
+		for n, size, (name, path) in it.product(
+				xrange(bench_rounds), bench_geometries, paths ):
+			conf = conf_init(dict( monitor_size=size, hflip_chance='0',
+				cache_dir=os.path.join(tmp_dir, 'cache'), cache_size=bytes(2**40),
+				index_db=os.path.join(tmp_dir, 'index.sqlite'),
+				result_path=os.path.join(tmp_dir, 'result.{monitor}.{id}.png') ))
+			ts, res = time.time(), 'ok'
+			try: info = wpset(path, mode='render')
+			except WPSError as err: res, info = 'err:{}'.format(err), dict()
+			except Exception as err:
+				pdb.gimp_message('WPS-WARN: Run failed ({}, {}): {}'.format(path, size, traceback.format_exc()))
+				res, info = 'err:gimp_error', dict()
+			if info.get('path') and not info['path'].startswith('pixbuf:'): os.unlink(info['path'])
+			pixbufs.clear()
+			runs.append(dict( image=name, size=size, round=n, result=res,
+				time=round(time.time() - ts, 3), cache=info.get('cache'), seams=info.get('seams'),
+				stages=dict((k[5:], dict(time=v, rss_peak=info['rss_peak_{}'.format(k[5:])]))
+					for k,v in info.viewitems() if k.startswith('time_')) ))
+		lqr_runs = bench_lqr_backends(paths, bench_geometries[-1])
+	finally:
+		conf = conf_bench
+		for p in list(_sqlite_dbs):
+			if p.startswith(tmp_dir): _sqlite_dbs.pop(p).close()
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+
+	stages = collections.defaultdict(list)
+	for run in runs:
+		for k, v in run['stages'].viewitems(): stages[k].append(v)
+	cache = list(run['cache'] for run in runs if run['cache'])
+	seams = list(run['seams'] for run in runs if run['seams'])
+	with open(path_res, 'wb') as dst:
+		json.dump(dict(
+			gimp=gimp.version, lqr_backend=conf.lqr_backend, runs=runs, lqr_backends=dict(
+				runs=lqr_runs, time=dict((k, round(sum( run[k] for run in lqr_runs
+					if run[k] != 'unavailable' ), 3)) for k in lqr_backends) ),
+			time=round(sum(run['time'] for run in runs), 3),
+			cache_hit_rate=round(cache.count('hit') / float(len(cache)), 3) if cache else None,
+			seams_hit_rate=round(seams.count('hit') / float(len(seams)), 3) if seams else None,
+			rejected=sum(run['result'] != 'ok' for run in runs),
+			stages=dict((k, dict( count=len(v),
+				time=round(sum(st['time'] for st in v), 3),
+				time_max=max(st['time'] for st in v),
+				rss_peak_max=max(st['rss_peak'] for st in v) )) for k, v in stages.viewitems()) ),
+			dst, indent=2, sort_keys=True )
 
 
 
@@ -673,6 +1706,9 @@ label_tags = [
 			if not isinstance(ts, datetime) else ts).strftime(ts_format)),
 	('set', [], lambda ts: datetime.now().strftime(ts_format)) ]
 
+# Labels that are different on every run, rendered separately from cached label tiles
+label_tags_volatile = set(['set'])
+
 # Stuff that should never appear in the label (searched there), can be a compiled regex
 label_tags_discard = set(['SONY DSC', 'DIGITAL CAMERA'])
 
@@ -685,4 +1721,20 @@ register(
 	'2018', 'LQRify to desktop', 'RGB*',
 	[(PF_FILE, 'file_name', 'Input file name', '')], [],
 	lqr_wpset )
+register(
+	'lqr_wpset_worker',
+	'LQRify to desktop (persistent worker)', lqr_wpset_worker.__doc__,
+	__author__, __copyright__,
+	'2018', '', '',
+	[ (PF_STRING, 'path_req', 'Path to read jobs from', ''),
+		(PF_STRING, 'path_res', 'Path to write results to', '') ], [],
+	lqr_wpset_worker )
+register(
+	'lqr_wpset_bench',
+	'LQRify to desktop (benchmark)', lqr_wpset_bench.__doc__,
+	__author__, __copyright__,
+	'2018', '', '',
+	[ (PF_STRING, 'corpus_dir', 'Path to dir with benchmark images', ''),
+		(PF_STRING, 'path_res', 'Path to write JSON results to', '') ], [],
+	lqr_wpset_bench )
 main()